@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.markup
+    ~~~~~~~~~~~~~~~~~
+
+    Markup emission benchmarks, the menus' own builder against werkzeug's
+    generic one, per menu item, for the markup alone and for whole renders.
+
+    Run it with ``python benchmarks/markup.py``, see ``--help`` for the
+    options. Werkzeug's builder is only measured on the releases still
+    having it.
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_menubuilder import MarkupBuilder
+from render import build, create_app, measure, render_all
+
+try:
+    from werkzeug.utils import html as werkzeug_html
+except ImportError:
+    werkzeug_html = None
+
+
+def builders():
+    yield 'menubuilder', MarkupBuilder('html')
+    if werkzeug_html is not None:
+        yield 'werkzeug', werkzeug_html
+
+
+def item_markup(builder, count):
+    def func():
+        li, a = builder.li, builder.a
+        for n in range(count):
+            li(a(u'Item', class_='inactive', href='/item/{0}'.format(n % 10)),
+               None, class_='inactive')
+    return func
+
+
+def render_markup(app, size, builder, compiled):
+    menubuilder = build(app, size)
+    menubuilder.builder = builder
+    for menu in menubuilder.menus.values():
+        menu.builder = builder
+        for entry in menu.sorted_entries:
+            entry.builder = builder
+    if compiled:
+        menubuilder.compile()
+
+    def func():
+        with app.test_request_context('/item/0'):
+            render_all(menubuilder)
+    return func
+
+
+def render_output(app, size, builder):
+    menubuilder = build(app, size)
+    menubuilder.builder = builder
+    for menu in menubuilder.menus.values():
+        menu.builder = builder
+        for entry in menu.sorted_entries:
+            entry.builder = builder
+    with app.test_request_context('/item/0'):
+        return [unicode(menubuilder.render(menu_id)) for menu_id in sorted(menubuilder.menus)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--size', type=int, default=1000,
+                        help='menu items per run, default: %(default)s')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds spent per benchmark')
+    args = parser.parse_args()
+
+    app = create_app(args.size)
+    outputs = [render_output(app, args.size, builder) for _, builder in builders()]
+    if len(outputs) > 1 and outputs[0] != outputs[1]:
+        sys.exit('The builders output differs')
+
+    scenarios = [('item markup', lambda builder: item_markup(builder, args.size))]
+    for compiled in (False, True):
+        scenarios.append((
+            'render compiled={0}'.format(compiled),
+            lambda builder, compiled=compiled: render_markup(
+                app, args.size, builder, compiled
+            )
+        ))
+    for scenario, factory in scenarios:
+        timings = {}
+        for name, builder in builders():
+            timings[name] = measure(factory(builder), args.min_time)[0] / args.size
+            print('{0:<25} {1:<12} {2:>10.2f} us/item'.format(
+                scenario, name, timings[name] * 1e6
+            ))
+        if 'werkzeug' in timings:
+            print('{0:<25} {1:<12} {2:>10.2f}x'.format(
+                scenario, 'speedup', timings['werkzeug'] / timings['menubuilder']
+            ))
+
+
+if __name__ == '__main__':
+    main()
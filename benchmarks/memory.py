@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.memory
+    ~~~~~~~~~~~~~~~~~
+
+    Measures the memory used per menu item.
+
+    Run it with ``python benchmarks/memory.py [items]``.
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask_menubuilder import Menu, MenuItem
+
+
+def deep_sizeof(obj, seen):
+    """
+    Size of `obj` plus everything it references which isn't shared, ie,
+    already seen, nor a class, function or module.
+    """
+    if id(obj) in seen or isinstance(obj, (type, type(deep_sizeof), type(sys))):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    for referent in gc.get_referents(obj):
+        size += deep_sizeof(referent, seen)
+    return size
+
+
+def bytes_per_item(count):
+    menu = Menu('main')
+    menu.builder = None
+    items = [
+        MenuItem('Item %d' % n, 'endpoint_%d' % n, priority=n % 10)
+        for n in range(count)
+    ]
+    # Don't account for what's shared by every item, nor for the titles and
+    # endpoints, which are the same whatever the representation.
+    seen = set()
+    deep_sizeof(menu, seen)
+    for item in items:
+        deep_sizeof(item.title, seen)
+        deep_sizeof(item.endpoint, seen)
+    for item in items:
+        menu.add_menu_item(item)
+    return float(deep_sizeof(items, seen) - sys.getsizeof(items)) / count
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+    print('{0} items: {1:.1f} bytes per item'.format(count, bytes_per_item(count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.render
+    ~~~~~~~~~~~~~~~~~
+
+    Menu construction and rendering benchmarks.
+
+    Run it with ``python benchmarks/render.py``, see ``--help`` for the
+    options. Use ``--json`` to save the results and ``--compare`` to compare
+    them against a previous run, ie, from another commit.
+
+    :copyright: © 2011 UfSoft.org - :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :license: BSD, see LICENSE for more details.
+"""
+
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, request
+from flask_menubuilder import MenuBuilder, MenuItemContent
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SIZES = (10, 100, 1000, 10000)
+
+
+def noop():
+    pass
+
+
+def create_app(size):
+    app = Flask(__name__)
+    for n in range(size):
+        app.add_url_rule('/item/{0}'.format(n), 'item_{0}'.format(n), noop)
+    return app
+
+
+def build(app, size, format='html', predicates='default', content=False, menus=1):
+    menubuilder = MenuBuilder(app, format=format, context_processor=False)
+    for menu_n in range(menus):
+        menu_id = 'menu_{0}'.format(menu_n)
+        menubuilder.add_menu(menu_id)
+        for n in range(size):
+            endpoint = 'item_{0}'.format(n)
+            kwargs = {}
+            if predicates == 'callable':
+                kwargs['activewhen'] = lambda mi: request.endpoint == mi.endpoint
+                kwargs['visiblewhen'] = lambda mi: True
+            if content:
+                menubuilder.add_menu_item(menu_id, MenuItemContent(
+                    lambda mi: mi.endpoint, title='Item {0}'.format(n),
+                    endpoint=endpoint, priority=n % 7, **kwargs
+                ))
+            else:
+                menubuilder.add_menu_entry(
+                    menu_id, 'Item {0}'.format(n), endpoint, priority=n % 7, **kwargs
+                )
+    return menubuilder
+
+
+def render_all(menubuilder):
+    for menu_id in menubuilder.menus:
+        menubuilder.render(menu_id)
+
+
+def measure(func, min_time):
+    """
+    Run `func` until `min_time` seconds are spent, at least three times, and
+    return the best time per call, in seconds, the number of objects tracked
+    by the garbage collector a single call leaves allocated, ie, the menus
+    built or the entries cached, and the peak of the memory allocated by a
+    single call, in bytes, when tracemalloc is available, ie, on Python 3.
+    """
+    func()  # Warm up
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < 3 or total < min_time:
+        gc.disable()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        gc.enable()
+        best = best is None and elapsed or min(best, elapsed)
+        total += elapsed
+        runs += 1
+    # The objects alive before are kept referenced so that their ids aren't
+    # reused, and the result for the objects it holds to be counted
+    gc.collect()
+    before = gc.get_objects()
+    result = func()
+    gc.collect()
+    known = set(id(obj) for obj in before)
+    objects = len([obj for obj in gc.get_objects() if id(obj) not in known])
+    del before, result
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, objects, peak
+
+
+def scenarios(sizes):
+    for size in sizes:
+        yield 'build', size, {}
+        for format in ('html', 'xhtml'):
+            yield 'render', size, {'format': format}
+        yield 'render', size, {'predicates': 'callable'}
+        yield 'render', size, {'content': True}
+        yield 'render', max(size // 10, 1), {'menus': 10}
+
+
+def run(sizes, min_time):
+    results = []
+    apps = {}
+    for kind, size, options in scenarios(sizes):
+        app = apps.get(size)
+        if app is None:
+            app = apps[size] = create_app(size)
+        if kind == 'build':
+            def func():
+                return build(app, size, **options)
+        else:
+            menubuilder = build(app, size, **options)
+
+            def func():
+                with app.test_request_context('/item/0'):
+                    render_all(menubuilder)
+        best, objects, peak = measure(func, min_time)
+        items = size * options.get('menus', 1)
+        name = '{0} size={1} {2}'.format(kind, size, ' '.join(
+            '{0}={1}'.format(key, value) for key, value in sorted(options.items())
+        )).strip()
+        results.append({
+            'name': name,
+            'seconds': best,
+            'items_per_second': items / best,
+            'objects': objects,
+            'peak_bytes': peak,
+        })
+        print('{0:<45} {1:>12.1f} items/s {2:>10} objects {3:>12} bytes'.format(
+            name, items / best, objects, peak is None and 'n/a' or peak
+        ))
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, filename):
+    with open(filename) as fp:
+        previous = dict(
+            (result['name'], result) for result in json.load(fp)['results']
+        )
+    print('\nCompared to {0}:'.format(filename))
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        print('{0:<45} {1:>+8.1f}%'.format(
+            result['name'],
+            (result['items_per_second'] / old['items_per_second'] - 1) * 100
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Menu construction and rendering benchmarks.'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='menu sizes to benchmark, default: %(default)s')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds spent per benchmark')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare with the results in this file')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.min_time)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({
+                'revision': git_revision(),
+                'python': sys.version.split()[0],
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,59 +7,989 @@
     :license: BSD, see LICENSE for more details.
 """
 
-from flask import url_for, request
-from jinja2 import Markup
-import werkzeug.utils
+import atexit
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from functools import partial
+from heapq import heapify, heappop
+from multiprocessing.pool import ThreadPool
+from flask import (
+    Blueprint, abort, current_app, g, has_request_context, jsonify,
+    make_response, url_for, request
+)
+from flask.globals import _app_ctx_stack, _request_ctx_stack
+from flask.signals import Namespace
+from jinja2 import Markup, TemplateSyntaxError, nodes
+from jinja2.ext import Extension
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import BuildError
+
+try:
+    import click
+    from flask.cli import AppGroup
+except ImportError:
+    # Flask < 0.11, no command line interface
+    AppGroup = None
 
 NEVER = object()
 ANYTIME = object()
 
+_signals = Namespace()
+
+#: Sent by :meth:`MenuBuilder.render` before rendering a menu, with the
+#: `menu_id` keyword argument
+menu_render_started = _signals.signal('menu-render-started')
+#: Sent by :meth:`MenuBuilder.render` after rendering a menu, with the
+#: `menu_id` and `duration`, in seconds, keyword arguments
+menu_rendered = _signals.signal('menu-rendered')
+
+
+def _has_receivers(signal):
+    # Flask's stand-in signals, used when blinker isn't installed, have none
+    return bool(getattr(signal, 'receivers', None))
+
+# Words indexed for searching, see `SearchIndex`
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+# Compiled markup is split on these markers; the odd indexes of the resulting
+# list are slot names which get filled in at render time.
+_SLOT_RE = re.compile(u'\x00(\\w+)\x00')
+
+
+def _slot(name):
+    return u'\x00{0}\x00'.format(name)
+
+
+def _fill_slots(fragments, values):
+    parts = list(fragments)
+    parts[1::2] = [values[name] for name in fragments[1::2]]
+    return u''.join(parts)
+
 
 def request_enpoint_matches_menuitem_endpoint(menu_item):
     return request.endpoint == menu_item.endpoint
 
+request_enpoint_matches_menuitem_endpoint.depends_on = frozenset(['endpoint'])
+
 
 # Simple "alias"
 REQUEST_MATCHES_ENDPOINT = request_enpoint_matches_menuitem_endpoint
 
 
+# How to get a hashable value out of the request for each of the attributes
+# the predicates can depend on.
+REQUEST_DEPENDENCIES = {
+    'endpoint': lambda request: request.endpoint,
+    'path': lambda request: request.path,
+    'blueprint': lambda request: request.blueprint,
+    'view_args': lambda request: tuple(sorted((request.view_args or {}).items())),
+}
+
+
+def predicate_dependencies(predicate):
+    """
+    Return the request attributes the `predicate` depends on or ``None`` if
+    those are unknown, ie, it's an opaque callable.
+    """
+    if predicate is NEVER or predicate is ANYTIME:
+        return frozenset()
+    return getattr(predicate, 'depends_on', None)
+
+
+class Predicate(object):
+    """
+    Base class for the declarative `activewhen`/`visiblewhen` predicates.
+    Subclasses declare which request attributes, see `REQUEST_DEPENDENCIES`,
+    their result depends on so that rendered menus can be cached correctly.
+    """
+    depends_on = frozenset()
+    #: Whether the result is the same for every menu item, in which case it's
+    #: shared by all of them within :meth:`MenuBuilder.render_many`
+    item_independent = False
+
+    def __call__(self, menu_item):
+        raise NotImplementedError
+
+
+class EndpointIn(Predicate):
+    """
+    The request endpoint is one of `endpoints`.
+    """
+    depends_on = frozenset(['endpoint'])
+    item_independent = True
+
+    def __init__(self, *endpoints):
+        self.endpoints = frozenset(endpoints)
+
+    def __call__(self, menu_item):
+        return request.endpoint in self.endpoints
+
+
+class PathPrefix(Predicate):
+    """
+    The request path starts with `prefix`.
+    """
+    depends_on = frozenset(['path'])
+    item_independent = True
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def __call__(self, menu_item):
+        return request.path.startswith(self.prefix)
+
+
+class BlueprintIs(Predicate):
+    """
+    The request is handled by one of the `blueprints`.
+    """
+    depends_on = frozenset(['blueprint'])
+    item_independent = True
+
+    def __init__(self, *blueprints):
+        self.blueprints = frozenset(blueprints)
+
+    def __call__(self, menu_item):
+        return request.blueprint in self.blueprints
+
+
+class ViewArgEquals(Predicate):
+    """
+    The request view argument `name` equals `value`.
+    """
+    depends_on = frozenset(['view_args'])
+    item_independent = True
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def __call__(self, menu_item):
+        view_args = request.view_args or {}
+        return self.name in view_args and view_args[self.name] == self.value
+
+
+class _FrozenDict(dict):
+    """
+    A dictionary which can't be changed in place. Use `copy()` to get a
+    mutable one.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{0!r} is immutable'.format(self))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+
+# Shared by all render items without extra HTML options
+EMPTY_OPTS = _FrozenDict()
+
+# Default active trail, ie, no menu item has an active descendant
+EMPTY_TRAIL = frozenset()
+
+
+class SharedPredicate(Predicate):
+    """
+    Wraps a predicate whose result doesn't depend on the menu item it's
+    called for, ie, "the user is an admin". It's evaluated once per request,
+    the result being stored on :data:`flask.g` and reused by every menu and
+    menu item using it, in every menu. Use :func:`shared_predicate` to create
+    them.
+    """
+    item_independent = True
+
+    def __init__(self, predicate, depends_on=None):
+        self.predicate = predicate
+        self.depends_on = depends_on
+
+    def __call__(self, render_item):
+        if not has_request_context():
+            return self.predicate(render_item)
+        cache = getattr(g, '_menubuilder_predicates', None)
+        if cache is None:
+            cache = g._menubuilder_predicates = {}
+        try:
+            return cache[self]
+        except KeyError:
+            result = cache[self] = self.predicate(render_item)
+            return result
+
+
+def shared_predicate(predicate=None, depends_on=None):
+    """
+    Decorator turning `predicate` into a :class:`SharedPredicate`. Pass
+    `depends_on`, the request attributes the result depends on, see
+    `REQUEST_DEPENDENCIES`, to keep the menus using it cacheable::
+
+        @shared_predicate
+        def is_admin(menu_item):
+            return current_user.has_role('admin')
+    """
+    if predicate is None:
+        return lambda predicate: SharedPredicate(predicate, depends_on)
+    return SharedPredicate(predicate, depends_on)
+
+
+def _is_visible_in_context(contexts, render_item):
+    # Runs on a predicates pool thread, on behalf of the rendering thread,
+    # whose application and request contexts are made current without being
+    # pushed again, so `request`, `g` and `url_for()` are the same.
+    app_ctx, request_ctx, render_context = contexts
+    _app_ctx_stack.push(app_ctx)
+    _request_ctx_stack.push(request_ctx)
+    try:
+        return render_item.is_visible(render_context)
+    finally:
+        _request_ctx_stack.pop()
+        _app_ctx_stack.pop()
+
+
+def _shutdown_pool(pool, pid):
+    # Forked processes don't have the threads of their parent's pool
+    if os.getpid() == pid:
+        pool.terminate()
+        pool.join()
+
+
+def babel_locale():
+    """
+    The current Flask-Babel locale, the default `MenuBuilder.locale_selector`
+    when Flask-Babel is installed.
+    """
+    from flask_babel import get_locale
+    locale = get_locale()
+    return locale is not None and str(locale) or None
+
+
+# The `g` attributes holding results for the current request only
+_REQUEST_CACHES = ('_menubuilder_predicates', '_menubuilder_render_context')
+
+
+def _clear_request_caches(exc=None):
+    _pop_request_caches()
+
+
+def _pop_request_caches():
+    caches = {}
+    for name in _REQUEST_CACHES:
+        if hasattr(g, name):
+            caches[name] = getattr(g, name)
+            delattr(g, name)
+    return caches
+
+
+class RenderContext(object):
+    """
+    Request scoped memo of the URLs and predicate results, shared by all the
+    menus rendered with :meth:`MenuBuilder.render_many`. Results are shared
+    between menu items for `REQUEST_MATCHES_ENDPOINT`, per endpoint, and for
+    the item independent :class:`Predicate`\\s. Other callables are evaluated
+    for each menu item.
+    """
+    __slots__ = ('hrefs', 'results')
+
+    def __init__(self):
+        self.hrefs = {}
+        self.results = {}
+
+    def href(self, menu_item):
+        # MenuItemContent which aren't links have no href, even when a link
+        # for the same endpoint is memoized
+        if not getattr(menu_item, 'is_link', True):
+            return None
+        try:
+            return self.hrefs[menu_item.endpoint]
+        except KeyError:
+            href = self.hrefs[menu_item.endpoint] = menu_item.href
+            return href
+
+    def evaluate(self, predicate, render_item):
+        # Instrumented predicates share the results of the ones they wrap
+        shared = predicate
+        if isinstance(predicate, _InstrumentedPredicate):
+            shared = predicate.predicate
+        if shared is REQUEST_MATCHES_ENDPOINT:
+            key = (shared, render_item.endpoint)
+        elif getattr(predicate, 'item_independent', False):
+            key = shared
+        else:
+            return predicate(render_item)
+        try:
+            return self.results[key]
+        except KeyError:
+            result = self.results[key] = predicate(render_item)
+            return result
+
+
 class SkipRender(Exception):
     """
     Custom exception to trigger when an object is not supposed to render.
     """
 
 
+def _escape(value):
+    """
+    Escape `value` for an attribute or text, like ``werkzeug.utils.escape``.
+    """
+    if value is None:
+        return u''
+    if hasattr(value, '__html__'):
+        return unicode(value.__html__())
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('"', '&quot;')
+
+
+# Attribute values cached by `MarkupBuilder`, lazy strings aren't since their
+# text changes with the locale. The type is part of the key, `Markup` being
+# equal to the same, but escaped, plain string
+_CACHED_TYPES = frozenset([str, unicode, Markup])
+
+
+# `RenderItem.html_opts` values rendered the same way for every request
+_PLAIN_OPT_TYPES = (basestring, int, long, float)
+
+
+def _element(tag):
+    """
+    Return the `MarkupBuilder` method emitting `tag` elements with their
+    children and, from the keyword arguments, attributes.
+    """
+    opening = u'<' + tag
+    closing = u'</' + tag + u'>'
+
+    def element(self, *children, **attributes):
+        markup = opening
+        if attributes:
+            keywords = tuple(attributes)
+            order = self._orders.get(keywords)
+            if order is None:
+                order = self._order(keywords)
+            cache = self._attributes
+            for keyword in order:
+                value = attributes[keyword]
+                if value is None:
+                    continue
+                if value.__class__ in _CACHED_TYPES:
+                    attribute = cache.get((keyword, value.__class__, value))
+                    if attribute is None:
+                        attribute = self._cached_attribute(keyword, value)
+                else:
+                    attribute = self._attribute(keyword, value)
+                markup += attribute
+        return markup + u'>' + u''.join(
+            [unicode(child) for child in children if child is not None]
+        ) + closing
+
+    element.__name__ = tag
+    return element
+
+
+class MarkupBuilder(object):
+    """
+    Emits the elements menus are made of, the default `MenuBuilder.builder`.
+    The attributes, passed as keyword arguments with a trailing underscore
+    for reserved names, ie, ``class_``, come in a fixed order, ``id``,
+    ``class`` and ``href`` first and then the others sorted by name. The
+    rendered attributes are memoized, the same values being used over and
+    over by the menu items.
+
+    Any object with the same ``ul``, ``ol``, ``li``, ``a`` and ``span``
+    methods can be used instead, like ``werkzeug.utils.html`` where it's
+    still available.
+    """
+    BOOLEAN_ATTRIBUTES = frozenset([
+        'selected', 'checked', 'compact', 'declare', 'defer', 'disabled',
+        'ismap', 'multiple', 'nohref', 'noresize', 'noshade', 'nowrap'
+    ])
+    ATTRIBUTES_ORDER = {'id': 0, 'class': 1, 'href': 2}
+
+    def __init__(self, dialect='html', cache_size=4096):
+        assert dialect in ('html', 'xhtml')
+        self.dialect = dialect
+        self.cache_size = cache_size
+        # (keyword, type, value) -> u' name="escaped value"'
+        self._attributes = {}
+        # keywords, as iterated -> the keywords in attributes order
+        self._orders = {}
+
+    def _attribute(self, keyword, value):
+        name = keyword[-1] == '_' and keyword[:-1] or keyword
+        if name in self.BOOLEAN_ATTRIBUTES:
+            if not value:
+                return u''
+            if self.dialect == 'xhtml':
+                return u' {0}="{0}"'.format(name)
+            return u' ' + name
+        return u' {0}="{1}"'.format(name, _escape(value))
+
+    def _order(self, keywords):
+        order = self._orders.get(keywords)
+        if order is None:
+            order = self._orders[keywords] = tuple(sorted(keywords, key=lambda keyword: (
+                self.ATTRIBUTES_ORDER.get(keyword.rstrip('_'), 3), keyword.rstrip('_')
+            )))
+        return order
+
+    def _cached_attribute(self, keyword, value):
+        if len(self._attributes) >= self.cache_size:
+            self._attributes.clear()
+        attribute = self._attributes[keyword, value.__class__, value] = \
+            self._attribute(keyword, value)
+        return attribute
+
+    ul = _element('ul')
+    ol = _element('ol')
+    li = _element('li')
+    a = _element('a')
+    span = _element('span')
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping which keeps at most `maxsize` entries, evicting the
+    least recently used ones first.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def prune(self, predicate):
+        """
+        Remove every entry whose key matches `predicate`.
+        """
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SearchIndex(object):
+    """
+    Prefix index over the words of the menu items' titles, endpoints and ids,
+    see :meth:`MenuBuilder.search`. Lazy titles, ie, translations, can only
+    be resolved within a request, the items having them are indexed again
+    with their resolved titles per locale, on the first search for it.
+    """
+    def __init__(self, locale_cache_size=64):
+        # Sorted words, looked up by prefix with bisect
+        self._words = []
+        # word -> set of menu items
+        self._postings = {}
+        # menu_item -> (sequence, words)
+        self._items = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        # Menu items with lazy texts -> (sequence, words), bumping the version
+        self._translated = {}
+        self._version = 0
+        # (locale, version) -> SearchIndex of the translated menu items
+        self._locales = LRUCache(locale_cache_size)
+
+    @staticmethod
+    def words(menu_item):
+        words = set()
+        for text in (menu_item.title, getattr(menu_item, 'content', None)):
+            if isinstance(text, basestring):
+                words.update(_WORD_RE.findall(text.lower()))
+        for key in (menu_item.endpoint, menu_item.id_):
+            if isinstance(key, basestring):
+                key = key.lower()
+                words.add(key)
+                words.update(_WORD_RE.findall(key))
+        return words
+
+    @staticmethod
+    def lazy_texts(menu_item):
+        return [
+            text for text in (menu_item.title, getattr(menu_item, 'content', None))
+            if text is not None and not callable(text) and not isinstance(text, basestring)
+        ]
+
+    def add(self, menu_item):
+        with self._lock:
+            self._remove(menu_item)
+            words = self.words(menu_item)
+            self._sequence += 1
+            self._insert(menu_item, self._sequence, words)
+            if self.lazy_texts(menu_item):
+                self._translated[menu_item] = (self._sequence, words)
+                self._version += 1
+
+    def remove(self, menu_item):
+        with self._lock:
+            self._remove(menu_item)
+
+    def _insert(self, menu_item, sequence, words):
+        self._items[menu_item] = (sequence, words)
+        for word in words:
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = set()
+                insort(self._words, word)
+            postings.add(menu_item)
+
+    def _remove(self, menu_item):
+        sequence, words = self._items.pop(menu_item, (None, ()))
+        for word in words:
+            postings = self._postings[word]
+            postings.discard(menu_item)
+            if not postings:
+                del self._postings[word]
+                del self._words[bisect_left(self._words, word)]
+        if self._translated.pop(menu_item, None) is not None:
+            self._version += 1
+
+    def locale_index(self, locale):
+        """
+        Return the index of the menu items with lazy texts, resolved for the
+        current request, cached as the `locale` one. Only call it within a
+        request for `locale`.
+        """
+        with self._lock:
+            key = (locale, self._version)
+            translated = list(self._translated.items())
+        index = self._locales.get(key)
+        if index is None:
+            index = SearchIndex(0)
+            for menu_item, (sequence, words) in translated:
+                words = set(words)
+                for text in self.lazy_texts(menu_item):
+                    words.update(_WORD_RE.findall(unicode(text).lower()))
+                index._insert(menu_item, sequence, words)
+            self._locales.set(key, index)
+        return index
+
+    def search(self, query, locale=None, translated=False):
+        """
+        Return the menu items having, for every word of `query`, a word
+        starting with it, as an iterator. Items matching whole words come
+        first, then in the order they were added. With `translated`, the lazy
+        texts are searched too, resolved for the `locale` of the request.
+        """
+        query_words = set(_WORD_RE.findall(query.lower()))
+        if not query_words:
+            return
+        with self._lock:
+            matches = self._matches(query_words)
+            if translated and self._translated:
+                translated_items = set(self._translated)
+            else:
+                translated_items = None
+        if translated_items:
+            # The translated items' own words are in the locale index too
+            matches = [match for match in matches if match[2] not in translated_items]
+            index = self.locale_index(locale)
+            with index._lock:
+                matches.extend(index._matches(query_words))
+        # Ranked lazily, callers usually only want the first few
+        heapify(matches)
+        while matches:
+            yield heappop(matches)[2]
+
+    def _matches(self, query_words):
+        # [(-number of query words matched whole, sequence, menu_item)]
+        ranges = {}
+        for query_word in query_words:
+            # Past the last word starting with query_word
+            successor = query_word[:-1] + unichr(ord(query_word[-1]) + 1)
+            ranges[query_word] = (bisect_left(self._words, query_word),
+                                  bisect_left(self._words, successor))
+        # Start from the narrowest range, then filter on the other words
+        seed = min(ranges, key=lambda word: ranges[word][1] - ranges[word][0])
+        start, end = ranges.pop(seed)
+        # menu_item -> number of query words matched whole
+        counts = dict.fromkeys(self._postings.get(seed, ()), 1)
+        for word in self._words[start:end]:
+            if word != seed:
+                for menu_item in self._postings[word]:
+                    counts.setdefault(menu_item, 0)
+        items = self._items
+        if not ranges:
+            return [(-count, items[menu_item][0], menu_item)
+                    for menu_item, count in counts.iteritems()]
+        matches = []
+        for menu_item, count in counts.iteritems():
+            sequence, words = items[menu_item]
+            for query_word in ranges:
+                if query_word in words:
+                    count += 1
+                elif not any(word.startswith(query_word) for word in words):
+                    break
+            else:
+                matches.append((-count, sequence, menu_item))
+        return matches
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _InstrumentedPredicate(object):
+    """
+    Wraps an `activewhen`/`visiblewhen` callable counting the calls and the
+    time spent on them. Declared dependencies and whether the result is item
+    independent are kept.
+    """
+    __slots__ = ('predicate', 'depends_on', 'item_independent', 'stats', 'lock')
+
+    def __init__(self, predicate, stats, lock):
+        self.predicate = predicate
+        self.depends_on = predicate_dependencies(predicate)
+        self.item_independent = getattr(predicate, 'item_independent', False)
+        self.stats = stats
+        self.lock = lock
+
+    def __call__(self, render_item):
+        start = time.time()
+        result = self.predicate(render_item)
+        elapsed = time.time() - start
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['time'] += elapsed
+            if result is False:
+                self.stats['false'] += 1
+        return result
+
+
+class MenuInstrumentation(object):
+    """
+    Collects per menu render timings, per item predicate call counts and
+    times and skipped renders. While disabled, the default, nothing is
+    wrapped nor measured.
+
+    Enabling it replaces the callable predicates of the menus and menu items
+    with counting wrappers, the original ones being restored when disabled.
+    """
+
+    #: Upper bounds, in seconds, of the render timing histogram buckets
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, float('inf'))
+
+    def __init__(self, menubuilder):
+        self.menubuilder = menubuilder
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.renders = {}
+            self.predicates = {}
+
+    def enable(self):
+        self.enabled = True
+        for menu in self.menubuilder.menus.values():
+            self.instrument(menu)
+
+    def disable(self):
+        self.enabled = False
+        for menu in self.menubuilder.menus.values():
+            self.instrument(menu, False)
+
+    def instrument(self, render_item, enable=True):
+        """
+        Wrap, or unwrap, the predicates of `render_item` and, if it's a menu,
+        of its entries and submenus.
+        """
+        for attr in ('activewhen', 'visiblewhen'):
+            predicate = getattr(render_item, attr)
+            wrapped = isinstance(predicate, _InstrumentedPredicate)
+            if enable and not wrapped and callable(predicate):
+                key = isinstance(render_item, Menu) and render_item.name or '{0}:{1}'.format(
+                    render_item.menu.name, render_item.endpoint
+                )
+                with self._lock:
+                    stats = self.predicates.setdefault(key, {}).setdefault(
+                        attr, {'calls': 0, 'time': 0.0, 'false': 0}
+                    )
+                # Not through the property, the menu's changed() is called
+                # once done, or by the one attaching the item
+                setattr(render_item, '_' + attr,
+                        _InstrumentedPredicate(predicate, stats, self._lock))
+            elif not enable and wrapped:
+                setattr(render_item, '_' + attr, predicate.predicate)
+        if isinstance(render_item, Menu):
+            for entry in render_item._current_entries():
+                self.instrument(entry, enable)
+                if entry.submenu is not None:
+                    self.instrument(entry.submenu, enable)
+            render_item.changed()
+
+    def record_render(self, menu_id, duration, skipped=False):
+        with self._lock:
+            stats = self.renders.get(menu_id)
+            if stats is None:
+                stats = self.renders[menu_id] = {
+                    'count': 0, 'time': 0.0, 'skipped': 0,
+                    'buckets': [0] * len(self.buckets)
+                }
+            stats['count'] += 1
+            stats['time'] += duration
+            if skipped:
+                stats['skipped'] += 1
+            for idx, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    stats['buckets'][idx] += 1
+                    break
+
+    def as_dict(self):
+        """
+        Export the collected data as plain dictionaries. The histogram
+        buckets are keyed by their upper bound, in seconds, and, for the
+        predicates, `false` is how many times they returned ``False``, which
+        for `visiblewhen` is the number of times the item was skipped.
+        """
+        with self._lock:
+            renders = {}
+            for menu_id, stats in self.renders.items():
+                stats = dict(stats)
+                stats['buckets'] = dict(
+                    (str(bound), count)
+                    for bound, count in zip(self.buckets, stats['buckets'])
+                )
+                renders[menu_id] = stats
+            predicates = dict(
+                (key, dict((attr, dict(stats)) for attr, stats in item.items()))
+                for key, item in self.predicates.items()
+            )
+        return {'renders': renders, 'predicates': predicates}
+
+
+class MenuExtension(Extension):
+    """
+    Jinja2 extension adding the ``{% menu "menu_id" %}`` tag. The menu is
+    looked up when the template is compiled and the tag compiles to a direct
+    call rendering it.
+    """
+    tags = set(['menu'])
+
+    def __init__(self, environment):
+        super(MenuExtension, self).__init__(environment)
+        environment.extend(menubuilder=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        menu_id = parser.parse_expression()
+        if not isinstance(menu_id, nodes.Const):
+            raise TemplateSyntaxError(
+                'The menu tag takes a constant menu id', lineno,
+                parser.name, parser.filename
+            )
+        menubuilder = self.environment.menubuilder
+        if menubuilder is None or not menubuilder.has_menu(menu_id.value):
+            raise TemplateSyntaxError(
+                'Unknown menu {0!r}'.format(menu_id.value), lineno,
+                parser.name, parser.filename
+            )
+        return nodes.Output(
+            [self.call_method('_render', [menu_id])], lineno=lineno
+        )
+
+    def _render(self, menu_id):
+        return self.environment.menubuilder.render(menu_id)
+
+
 class MenuBuilder(object):
     """
     This class will be attached to the Flask application and will be available
     within a template's context as `menubuilder`.
     """
-    def __init__(self, app=None, format='html'):
+    def __init__(self, app=None, format='html', href_cache_size=512,
+                 render_cache_size=0, context_processor=True, instrument=False,
+                 predicate_workers=4, locale_selector=None, locale_cache_size=64,
+                 builder=None):
         assert format in ('html', 'xhtml')
         self.format = format
-        self.builder = getattr(werkzeug.utils, self.format)
-        self.menus = {}
+        self.builder = builder or MarkupBuilder(self.format)
+        self._menus = {}
+        # Definitions recorded by `add_lazy_menu()`, `entry()` and
+        # `add_lazy_entries()`, built on first access to `menus`
+        self._pending_menus = []
+        self._pending_entries = []
+        self._build_lock = threading.RLock()
+        self._building = None
         self.raise_runtime_errors = False
+        self.app = None
+        # The endpoint serving the submenus markup, see `create_blueprint()`
+        self.submenu_endpoint = None
+        self.href_cache = LRUCache(href_cache_size)
+        self.render_cache = LRUCache(render_cache_size)
+        if locale_selector is None:
+            try:
+                import flask_babel
+            except ImportError:
+                pass
+            else:
+                locale_selector = babel_locale
+        # Callable returning the current locale, used to compile the menu
+        # items with translated, ie, lazy, titles once per locale
+        self.locale_selector = locale_selector
+        # (root menu, version, locale) -> {menu_item: fragments}
+        self.locale_variants = LRUCache(locale_cache_size)
+        # endpoint -> {menu_id: menu_item} and id_ -> {menu_id: menu_item}
+        self._endpoints = {}
+        self._ids = {}
+        self.search_index = SearchIndex(locale_cache_size)
+        self.instrumentation = MenuInstrumentation(self)
+        self.predicate_workers = predicate_workers
+        self._predicate_pool = None
+        # The process the pool was created in, its threads don't survive forks
+        self._predicate_pool_pid = None
+        self._predicate_pool_lock = threading.Lock()
+        if instrument:
+            self.instrumentation.enable()
         if app is not None:
-            self.init_app(app)
+            self.init_app(app, context_processor=context_processor)
 
-    def init_app(self, app):
+    def init_app(self, app, context_processor=True):
+        """
+        Attach to `app`. Templates can draw menus with the ``{% menu %}`` tag,
+        see :class:`MenuExtension`, the breadcrumbs with the `breadcrumbs()`
+        global, see :meth:`render_breadcrumbs`, and, unless
+        `context_processor` is false, through the `menubuilder` object in
+        their context.
+        """
         app.menubuilder = self
-        app.context_processor(lambda: dict(menubuilder=self))
+        if context_processor:
+            app.context_processor(lambda: dict(menubuilder=self))
+        app.jinja_env.add_extension(MenuExtension)
+        app.jinja_env.globals.setdefault('breadcrumbs', self.render_breadcrumbs)
+        if menubuilder_cli is not None:
+            app.cli.add_command(menubuilder_cli)
+        app.jinja_env.menubuilder = self
+        # The application context, and so `g`, may outlive the request
+        app.teardown_request(_clear_request_caches)
         self.app = app
 
+    def _get_menus(self):
+        self._build_pending()
+        return self._menus
+
+    def _set_menus(self, menus):
+        self._menus = menus
+
+    menus = property(_get_menus, _set_menus)
+
+    def add_lazy_menu(self, menu_id, **options):
+        """
+        Record a menu to be created, with the :meth:`add_menu` `options`, by
+        :meth:`build`. Menus which lazy entries are added to are created with
+        the default options if not added otherwise.
+        """
+        with self._build_lock:
+            self._pending_menus.append((menu_id, options))
+
+    def add_lazy_entries(self, menu_id, entries, blueprint=None):
+        """
+        Record `entries`, dictionaries of :class:`MenuItem` arguments, see
+        :meth:`add_menu_entries`, to be added to the `menu_id` menu by
+        :meth:`build`. The endpoints are relative to `blueprint`, if passed.
+        """
+        with self._build_lock:
+            for entry in entries:
+                entry = dict(entry)
+                if blueprint is not None:
+                    entry['endpoint'] = '{0}.{1}'.format(blueprint.name, entry['endpoint'])
+                self._pending_entries.append((menu_id, entry))
+
+    def entry(self, menu_id, title, endpoint=None, blueprint=None, **options):
+        """
+        Decorator recording a lazy entry, see :meth:`add_lazy_entries`, for
+        the decorated view function::
+
+            @app.route('/')
+            @menubuilder.entry('main', 'Home', priority=-1)
+            def index():
+                ...
+
+        The endpoint defaults to the view function's name, relative to
+        `blueprint` if passed.
+        """
+        def decorator(func):
+            options.update(title=title, endpoint=endpoint or func.__name__)
+            self.add_lazy_entries(menu_id, [options], blueprint=blueprint)
+            return func
+        return decorator
+
+    def build(self):
+        """
+        Create the lazily defined menus and entries. It's called on first
+        access to `menus`, ie, the first render, and can be called sooner,
+        ie, from a warm-up hook.
+        """
+        with self._build_lock:
+            if self._building is threading.current_thread():
+                # Accessing `menus` while building
+                return
+            if not (self._pending_menus or self._pending_entries):
+                return
+            self._building = threading.current_thread()
+            try:
+                for menu_id, options in self._pending_menus:
+                    if menu_id not in self._menus:
+                        self.add_menu(menu_id, **options)
+                batches = OrderedDict()
+                for menu_id, entry in self._pending_entries:
+                    batches.setdefault(menu_id, []).append(entry)
+                for menu_id, entries in batches.items():
+                    if menu_id not in self._menus:
+                        self.add_menu(menu_id)
+                    self.add_menu_entries(
+                        menu_id, entries, check_endpoints=self.app is not None
+                    )
+            finally:
+                # Errors are reported once, not on every access
+                self._pending_menus = []
+                self._pending_entries = []
+                self._building = None
+
     def add_menu(self, menu_id, id_=None, classes=None, visiblewhen=ANYTIME,
-                 activewhen=ANYTIME, **html_opts):
+                 activewhen=ANYTIME, concurrent=False, **html_opts):
         if menu_id in self.menus:
             if self.app.debug:
                 raise RuntimeError("There's already a menu with the id: %s", menu_id)
             raise RuntimeWarning("There's already a menu with the id: %s", menu_id)
         menu = Menu(
             menu_id, id_=id_, classes=classes, visiblewhen=visiblewhen,
-            activewhen=activewhen, **html_opts
+            activewhen=activewhen, concurrent=concurrent, **html_opts
         )
         menu.builder = self.builder
+        menu.menubuilder = self
         self.menus[menu_id] = menu
+        if self.instrumentation.enabled:
+            self.instrumentation.instrument(menu)
         return menu
 
     def add_menu_entry(self, menu_id, title, endpoint, priority=0,
@@ -86,38 +1016,644 @@ class MenuBuilder(object):
     def add_menu_item(self, menu_id, menu_item):
         return self.__add_menu_item(menu_id, menu_item)
 
+    def add_menu_entries(self, menu_id, entries, check_endpoints=True):
+        """
+        Add several entries at once to the `menu_id` menu. The `entries` are
+        :class:`MenuItem` instances or dictionaries of :class:`MenuItem`
+        arguments, which can have a ``submenu`` dictionary of
+        :meth:`MenuItem.add_submenu` arguments plus its own ``entries``.
+
+        The whole batch is validated before anything is added, reporting all
+        the problems found at once, including, if `check_endpoints` is true,
+        endpoints unknown to the application's URL map.
+        """
+        if menu_id not in self.menus:
+            self._raise(
+                '{0!r} menu does not exist yet. Please create it first with '
+                'Menubuilder.add_menu()'.format(menu_id)
+            )
+        menu = self.menus[menu_id]
+        endpoints = check_endpoints and self._url_map_endpoints()
+        errors = []
+        menu_items = self._build_menu_items(entries, errors, endpoints)
+        self._validate_menu_items(menu, menu_items, errors, endpoints)
+        if errors:
+            self._raise(
+                'Invalid entries for the {0!r} menu:\n{1}'.format(
+                    menu_id, '\n'.join(errors)
+                ), errors
+            )
+        return menu.add_menu_items(menu_items)
+
+    def add_menus(self, definitions, check_endpoints=True):
+        """
+        Add menus, or entries to existing ones, from a dictionary mapping the
+        menu ids to :meth:`add_menu` arguments plus an ``entries`` list, see
+        :meth:`add_menu_entries`. All the menus are validated before any of
+        them is touched.
+        """
+        endpoints = check_endpoints and self._url_map_endpoints()
+        errors = []
+        batches = []
+        for menu_id, definition in sorted(definitions.items()):
+            definition = dict(definition)
+            menu_items = self._build_menu_items(
+                definition.pop('entries', ()), errors, endpoints
+            )
+            self._validate_menu_items(
+                self.menus.get(menu_id), menu_items, errors, endpoints
+            )
+            batches.append((menu_id, definition, menu_items))
+        if errors:
+            self._raise('Invalid menu definitions:\n{0}'.format('\n'.join(errors)), errors)
+        for menu_id, definition, menu_items in batches:
+            if menu_id not in self.menus:
+                self.add_menu(menu_id, **definition)
+            self.menus[menu_id].add_menu_items(menu_items)
+
+    def load_menus(self, filename, check_endpoints=True):
+        """
+        Add the menus defined in a JSON, or TOML, file, see :meth:`add_menus`.
+        Loading TOML files requires Python 3.11 or the `toml` package.
+        """
+        with io.open(filename, encoding='utf-8') as fp:
+            data = fp.read()
+        if os.path.splitext(filename)[1].lower() == '.toml':
+            try:
+                import tomllib as toml
+            except ImportError:
+                import toml
+            definitions = toml.loads(data)
+        else:
+            definitions = json.loads(data)
+        self.add_menus(definitions, check_endpoints=check_endpoints)
+
     def has_menu(self, menu_id):
         return menu_id in self.menus
 
     def has_menu_endpoint(self, endpoint, menu_id=None):
+        self._build_pending()
+        menus = self._endpoints.get(endpoint)
+        if not menus:
+            return False
         if menu_id:
-            return endpoint in self.menus[menu_id]
-        for menu_id in self.menus.keys():
-            if endpoint in self.menus[menu_id]:
-                return True
-        return False
+            return menu_id in menus
+        return True
 
     def has_item_by_id(self, item_id, menu_id=None):
+        return self.get_item_by_id(item_id, menu_id) is not None
+
+    def get_item_by_id(self, item_id, menu_id=None):
+        """
+        Return the menu item with the `item_id` id, optionally restricting the
+        lookup to the `menu_id` menu, or ``None`` if there's none.
+        """
+        self._build_pending()
+        items = self._ids.get(item_id)
+        if not items:
+            return None
         if menu_id:
-            for menu_item in self.menus[menu_id].values():
-                if menu_item.id is None:
+            return items.get(menu_id)
+        return next(iter(items.values()))
+
+    def menus_for_endpoint(self, endpoint):
+        """
+        Return the menus which have an entry for `endpoint`.
+        """
+        self._build_pending()
+        return [self.menus[menu_id] for menu_id in self._endpoints.get(endpoint, ())]
+
+    def items_for_endpoint(self, endpoint):
+        """
+        Return the menu items, from all menus, for `endpoint`.
+        """
+        self._build_pending()
+        return list(self._endpoints.get(endpoint, {}).values())
+
+    def search(self, query, limit=10):
+        """
+        Return up to `limit` menu items, from all menus, with words in their
+        title, endpoint or id starting with each of the words of `query`, see
+        :class:`SearchIndex`. Translated titles are searched as they read in
+        the current locale, see `locale_selector`. Items not visible in the
+        current request, or within a menu which isn't, are left out.
+        """
+        self._build_pending()
+        context = self._render_context()
+        results = []
+        # Lazy titles are resolved, and cached, per locale, within requests
+        translated = has_request_context()
+        locale = None
+        if translated and self.locale_selector is not None:
+            locale = self.locale_selector()
+        for menu_item in self.search_index.search(query, locale, translated):
+            if len(results) >= limit:
+                break
+            render_item = menu_item
+            while render_item is not None and render_item.is_visible(context):
+                if isinstance(render_item, MenuItem):
+                    render_item = render_item.menu
+                else:
+                    render_item = render_item.parent
+            if render_item is None:
+                results.append(menu_item)
+        return results
+
+    def breadcrumbs(self, menu_id=None, endpoint=None):
+        """
+        Return the menu items leading to the one for `endpoint`, the current
+        request's by default, from the top level menu item down to it. The
+        first menu with an entry for it is used unless `menu_id` is passed.
+        """
+        self._build_pending()
+        items = self._endpoints.get(endpoint or request.endpoint)
+        if not items:
+            return []
+        if menu_id:
+            menu_item = items.get(menu_id)
+            if menu_item is None:
+                return []
+        else:
+            menu_item = next(iter(items.values()))
+        trail = [menu_item]
+        parent = menu_item.menu.parent
+        while parent is not None:
+            trail.append(parent)
+            parent = parent.menu is not None and parent.menu.parent or None
+        trail.reverse()
+        return trail
+
+    def render_breadcrumbs(self, menu_id=None, endpoint=None, class_='breadcrumbs'):
+        """
+        Render the :meth:`breadcrumbs` as an ordered list of links but for
+        the last one, the current page. Empty if there are none.
+        """
+        trail = self.breadcrumbs(menu_id, endpoint)
+        if not trail:
+            return Markup(u'')
+        context = self._render_context()
+        entries = []
+        for menu_item in trail:
+            title = menu_item.title
+            if title is None:
+                # Menu item contents may go untitled
+                title = menu_item.content
+                if callable(title):
+                    title = title(menu_item)
+            if menu_item is trail[-1]:
+                entries.append(self.builder.li(title, class_='active'))
+                continue
+            href = context.href(menu_item)
+            if href is None:
+                entries.append(self.builder.li(title))
+            else:
+                entries.append(self.builder.li(self.builder.a(title, href=href)))
+        return Markup(self.builder.ol('\n'.join(entries), class_=class_))
+
+    def render(self, menu_id, context=None):
+        instrumentation = self.instrumentation
+        if not (instrumentation.enabled or _has_receivers(menu_render_started) or
+                _has_receivers(menu_rendered)):
+            return self._render(menu_id, context)
+        menu_render_started.send(self, menu_id=menu_id)
+        start = time.time()
+        try:
+            output = self._render(menu_id, context)
+        except SkipRender:
+            if instrumentation.enabled:
+                instrumentation.record_render(menu_id, time.time() - start, True)
+            raise
+        duration = time.time() - start
+        if instrumentation.enabled:
+            instrumentation.record_render(menu_id, duration)
+        menu_rendered.send(self, menu_id=menu_id, duration=duration)
+        return output
+
+    def render_many(self, menu_ids):
+        """
+        Render several menus, returning an ordered mapping of the menu ids to
+        their markup, empty for the menus not visible. The URLs and the
+        predicate results are shared by all of them, and by other calls
+        within the same request, see :class:`RenderContext`.
+        """
+        context = self._render_context()
+        rendered = OrderedDict()
+        for menu_id in menu_ids:
+            try:
+                rendered[menu_id] = self.render(menu_id, context)
+            except SkipRender:
+                rendered[menu_id] = Markup(u'')
+        return rendered
+
+    def cache_key(self, menu_id):
+        """
+        Return a key identifying the output of the `menu_id` menu for the
+        current request, or ``None`` if it can't be known, see
+        :attr:`Menu.dependencies`.
+        """
+        menu = self.menus[menu_id]
+        dependencies = menu.dependencies
+        if dependencies is None or self._has_url_defaults():
+            return None
+        return (menu_id, menu.version, request.url_root) + tuple(
+            REQUEST_DEPENDENCIES[name](request) for name in sorted(dependencies)
+        )
+
+    def _render(self, menu_id, context=None):
+        menu = self.menus[menu_id]
+        key = self.render_cache.maxsize > 0 and self.cache_key(menu_id)
+        if not key:
+            return Markup(menu.render(context=context))
+        output = self.render_cache.get(key)
+        if output is None:
+            output = Markup(menu.render(context=context))
+            self.render_cache.set(key, output)
+        return output
+
+    def create_blueprint(self, name='menubuilder', cache_control='public, max-age=60',
+                         **options):
+        """
+        Create a blueprint serving the menus as separately cacheable
+        fragments, ``<menu_id>.html`` for the markup and ``<menu_id>.json``
+        for a tree of the entries, see :meth:`Menu.to_dict`. The menu is
+        rendered for the page at the ``path`` query argument, ``/`` if not
+        passed, so that the right entries are active. The submenus, lazy ones
+        included, are served the same way at ``<menu_id>/<endpoint>.html`` and
+        ``<menu_id>/<endpoint>.json``, `endpoint` being their menu item's.
+
+        Responses get a strong ETag, a hash of the output, and
+        ``If-None-Match`` requests a ``304``, for the menus whose output is
+        known to depend only on the request, see :meth:`cache_key`, and
+        `cache_control` as the Cache-Control header.
+        The `options` are passed to :class:`flask.Blueprint`.
+        """
+        blueprint = Blueprint(name, __name__, **options)
+        menubuilder = self
+
+        def fragment_response(menu_id, format, submenu=None):
+            current = _request_ctx_stack.top
+            outer_request = current.request
+            # The menu is rendered for the page, without the results shared
+            # for this request, the page request standing in for it
+            caches = _pop_request_caches()
+            current.request = menubuilder._page_request(request.args.get('path', '/'))
+            try:
+                cacheable = menubuilder.cache_key(menu_id) is not None
+                try:
+                    if format == 'json':
+                        menu = submenu or menubuilder.menus[menu_id]
+                        response = jsonify(menu.to_dict())
+                    elif submenu is not None:
+                        response = make_response(Markup(submenu.render()))
+                    else:
+                        response = make_response(menubuilder.render(menu_id))
+                except SkipRender:
+                    abort(404)
+            finally:
+                current.request = outer_request
+                _pop_request_caches()
+                for name, value in caches.items():
+                    setattr(g, name, value)
+            if cacheable:
+                # From the output, which the URL map, the predicates' options
+                # or the builder change as much as the menu does
+                response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+                response.make_conditional(request)
+            if cache_control:
+                response.headers['Cache-Control'] = cache_control
+            return response
+
+        @blueprint.route('/<menu_id>.<any(html, json):format>')
+        def fragment(menu_id, format):
+            if not menubuilder.has_menu(menu_id):
+                abort(404)
+            return fragment_response(menu_id, format)
+
+        @blueprint.route('/<menu_id>/<entry>.<any(html, json):format>')
+        def submenu_fragment(menu_id, entry, format):
+            menubuilder._build_pending()
+            menu_item = menubuilder._endpoints.get(entry, {}).get(menu_id)
+            if menu_item is None or menu_item.submenu is None:
+                abort(404)
+            return fragment_response(menu_id, format, menu_item.submenu)
+
+        @blueprint.record
+        def record(state):
+            menubuilder.submenu_endpoint = '{0}.submenu_fragment'.format(blueprint.name)
+
+        return blueprint
+
+    def _page_request(self, path):
+        """
+        Return a request for the page at `path`, made like the current one,
+        headers included, for the menus to be rendered as they're for that
+        page. It's routed through the URL map like Flask does, without
+        pushing another request context, whose teardown would run the
+        application's ``teardown_request`` functions within this request.
+        """
+        path, _, query = path.partition('?')
+        environ = dict(
+            request.environ, REQUEST_METHOD='GET', PATH_INFO=path.encode('utf-8'),
+            QUERY_STRING=query.encode('utf-8'), CONTENT_LENGTH='0', CONTENT_TYPE=''
+        )
+        environ['wsgi.input'] = io.BytesIO()
+        page_request = self.app.request_class(environ)
+        try:
+            page_request.url_rule, page_request.view_args = \
+                self.app.create_url_adapter(page_request).match(return_rule=True)
+        except HTTPException as error:
+            page_request.routing_exception = error
+        return page_request
+
+    def submenu_url(self, menu_item, format='html'):
+        """
+        Return the URL of the markup, or the JSON tree, of `menu_item`'s
+        submenu for the current page, served by the blueprint from
+        :meth:`create_blueprint`, which lazy submenus need registered.
+        """
+        if self.submenu_endpoint is None:
+            self._raise(
+                "The blueprint from create_blueprint() must be registered to "
+                "load the lazy submenu of {0!r}".format(menu_item.endpoint)
+            )
+        return url_for(
+            self.submenu_endpoint, menu_id=menu_item.menu.root.name,
+            entry=menu_item.endpoint, format=format, path=request.path
+        )
+
+    def locale_fragments(self, menu_item):
+        """
+        Return the compiled fragments of `menu_item` for the current locale,
+        compiling them on first use, or ``None`` if there's no locale or the
+        item has lazy HTML options, which are rendered for each request.
+        """
+        if self.locale_selector is None or self.locale_variants.maxsize <= 0 or \
+                not menu_item.plain_html_opts:
+            return None
+        locale = self.locale_selector()
+        if locale is None:
+            return None
+        # One variant for the whole tree, submenu changes bump the root's
+        # version too
+        root = menu_item.menu.root
+        key = (root, root.version, locale)
+        variant = self.locale_variants.get(key)
+        if variant is None:
+            variant = {}
+            self.locale_variants.set(key, variant)
+        fragments = variant.get(menu_item)
+        if fragments is None:
+            fragments = variant[menu_item] = menu_item.compile_fragments()
+        return fragments
+
+    def stream(self, menu_id):
+        """
+        Render the menu incrementally, see :meth:`Menu.iter_render`. Wrap it
+        with :func:`flask.stream_with_context` when consumed outside of the
+        request, ie, by a streamed response.
+        """
+        for chunk in self.menus[menu_id].iter_render():
+            yield Markup(chunk)
+
+    @property
+    def predicate_pool(self):
+        """
+        The pool of `predicate_workers` threads evaluating the visibility
+        predicates of the menus created with ``concurrent=True``, created
+        again in forked processes, ie, preloaded application workers.
+        """
+        pid = os.getpid()
+        if self._predicate_pool is None or self._predicate_pool_pid != pid:
+            with self._predicate_pool_lock:
+                if self._predicate_pool is None or self._predicate_pool_pid != pid:
+                    self._predicate_pool = ThreadPool(self.predicate_workers)
+                    self._predicate_pool_pid = pid
+                    # Otherwise its threads are left to die noisily at exit
+                    atexit.register(_shutdown_pool, self._predicate_pool, pid)
+        return self._predicate_pool
+
+    def evaluate_visibility(self, render_items, context=None):
+        """
+        Return whether each of the `render_items` is visible, evaluating the
+        callable predicates concurrently, within the current request context.
+        """
+        results = [None] * len(render_items)
+        pending = []
+        for idx, render_item in enumerate(render_items):
+            if callable(render_item.visiblewhen):
+                pending.append(idx)
+            else:
+                results[idx] = render_item.is_visible()
+        # Warming up mustn't start the pool, forked workers would inherit it
+        if len(pending) > 1 and self.predicate_workers > 0 and \
+                not getattr(g, '_menubuilder_warmup', False):
+            evaluate = partial(_is_visible_in_context, (
+                _app_ctx_stack.top, _request_ctx_stack.top, context
+            ))
+            visible = self.predicate_pool.map(
+                evaluate, [render_items[idx] for idx in pending]
+            )
+        else:
+            visible = [render_items[idx].is_visible(context) for idx in pending]
+        for idx, result in zip(pending, visible):
+            results[idx] = result
+        return results
+
+    def url_for(self, endpoint):
+        """
+        Memoized ``url_for(endpoint)``. The URL is cached per endpoint and URL
+        root, ie, scheme, host and script root, and per blueprint for the
+        relative endpoints, ie, ``.index``. Applications with URL default
+        functions get the URLs built every time since those can inject values
+        from anywhere, as do URLs built outside of requests, from the
+        ``SERVER_NAME`` of an application context.
+        """
+        if (self.href_cache.maxsize <= 0 or not has_request_context() or
+                self._has_url_defaults()):
+            return url_for(endpoint)
+        key = (endpoint, request.url_root)
+        if endpoint[:1] == '.':
+            # Relative to the current request's blueprint
+            key += (request.blueprint,)
+        href = self.href_cache.get(key)
+        if href is None:
+            href = url_for(endpoint)
+            self.href_cache.set(key, href)
+        return href
+
+    def invalidate_hrefs(self, endpoint=None):
+        """
+        Drop the memoized URLs for `endpoint`, or all of them if not passed.
+        """
+        if endpoint is None:
+            self.href_cache.clear()
+        else:
+            self.href_cache.prune(lambda key: key[0] == endpoint)
+
+    def compile(self, *menu_ids):
+        """
+        Pre-render the static markup of the passed menus, or all of them if
+        none is passed. See :meth:`Menu.compile`.
+        """
+        for menu_id in (menu_ids or self.menus.keys()):
+            self.menus[menu_id].compile()
+
+    def warmup(self, render=False, path='/', base_url=None):
+        """
+        Get the menus ready ahead of the first request, ie, before forking the
+        workers of a preloaded application: build the lazy definitions, check
+        that the endpoints of every link are in the URL map and that their
+        URLs can be built, and compile the menus, computing their sort order
+        and dependencies. With `render`, every menu is also rendered once for
+        the `path` page.
+
+        The URLs are memoized for `base_url`, ie, ``https://example.com/``,
+        which should be the URL root the application is served from. It
+        defaults to the ``SERVER_NAME`` one, if configured, else to
+        ``http://localhost/``, which only checks the URLs.
+
+        Return an ordered mapping of the menu ids to the seconds spent on
+        each. The problems found are reported at once, for all the menus.
+        """
+        self.app.url_map.update()
+        endpoints = self._url_map_endpoints()
+        errors = []
+        timings = OrderedDict()
+        with self.app.test_request_context(path, base_url=base_url):
+            g._menubuilder_warmup = True
+            for menu_id in sorted(self.menus):
+                start = time.time()
+                menu = self.menus[menu_id]
+                menu_errors = self._warmup_hrefs(menu, endpoints)
+                if menu_errors:
+                    errors.extend(
+                        '{0}: {1}'.format(menu_id, error) for error in menu_errors
+                    )
                     continue
-                if menu_item.id == item_id:
-                    return True
-            return False
+                menu.compile()
+                menu.active_trail()
+                menu.dependencies
+                if render:
+                    try:
+                        self.render(menu_id)
+                    except SkipRender:
+                        pass
+                timings[menu_id] = time.time() - start
+        if errors:
+            self._raise('Invalid menu entries:\n{0}'.format('\n'.join(errors)), errors)
+        return timings
+
+    # Private Methods
+    def _build_pending(self):
+        # Lookups in the indexes, like in `menus`, need the lazy definitions
+        if self._pending_menus or self._pending_entries:
+            self.build()
+
+    def _raise(self, msg, *args):
+        if self.app.debug:
+            raise RuntimeError(msg, *args)
+        raise RuntimeWarning(msg, *args)
+
+    def _url_map_endpoints(self):
+        return frozenset(rule.endpoint for rule in self.app.url_map.iter_rules())
 
-        for menu_id in self.menus.keys():
-            for menu_item in self.menus[menu_id].values():
-                if menu_item.id is None:
+    def _build_menu_items(self, entries, errors, endpoints=None):
+        menu_items = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = dict(entry)
+                submenu = entry.pop('submenu', None)
+                try:
+                    entry = MenuItem(**entry)
+                except TypeError as err:
+                    errors.append('Invalid menu entry {0!r}: {1}'.format(entry, err))
                     continue
-                if menu_item.id == item_id:
-                    return True
-        return False
+                if submenu is not None:
+                    submenu = dict(submenu)
+                    submenu_errors = []
+                    submenu_items = self._build_menu_items(
+                        submenu.pop('entries', ()), submenu_errors, endpoints
+                    )
+                    self._validate_menu_items(
+                        None, submenu_items, submenu_errors, endpoints
+                    )
+                    errors.extend(submenu_errors)
+                    entry.add_submenu(**submenu)
+                    if not submenu_errors:
+                        entry.submenu.add_menu_items(submenu_items)
+            menu_items.append(entry)
+        return menu_items
 
-    def render(self, menu_id):
-        return Markup(self.menus[menu_id].render())
+    def _validate_menu_items(self, menu, menu_items, errors, endpoints=None):
+        seen = set(menu is not None and menu.entries or ())
+        for menu_item in menu_items:
+            if not isinstance(menu_item, MenuItem):
+                errors.append('{0!r} is not a MenuItem'.format(menu_item))
+                continue
+            if menu_item.endpoint in seen:
+                errors.append("There's already a menu entry for the endpoint {0} in {1!r}".format(
+                    menu_item.endpoint, menu is not None and menu.name or None
+                ))
+            seen.add(menu_item.endpoint)
+            is_link = getattr(menu_item, 'is_link', True)
+            if endpoints and is_link and menu_item.endpoint not in endpoints:
+                errors.append('Unknown endpoint {0!r}'.format(menu_item.endpoint))
+            if menu_item.submenu is not None:
+                self._validate_menu_items(
+                    None, menu_item.submenu.sorted_entries, errors, endpoints
+                )
+
+    def _warmup_hrefs(self, menu, endpoints):
+        errors = []
+        pending = [menu]
+        while pending:
+            for menu_item in pending.pop().sorted_entries:
+                if menu_item.submenu is not None:
+                    pending.append(menu_item.submenu)
+                if not getattr(menu_item, 'is_link', True):
+                    continue
+                if menu_item.endpoint not in endpoints:
+                    errors.append('Unknown endpoint {0!r}'.format(menu_item.endpoint))
+                    continue
+                try:
+                    self.url_for(menu_item.endpoint)
+                except BuildError:
+                    errors.append('Cannot build an URL for the endpoint {0!r}'.format(
+                        menu_item.endpoint
+                    ))
+        return errors
+
+    def _render_context(self):
+        """
+        Return the :class:`RenderContext` shared within the current request.
+        """
+        context = getattr(g, '_menubuilder_render_context', None)
+        if context is None:
+            context = g._menubuilder_render_context = RenderContext()
+        return context
+
+    def _has_url_defaults(self):
+        return any(self.app.url_default_functions.values())
+
+    def _menu_changed(self, menu):
+        self.render_cache.prune(lambda key: key[0] == menu.name)
+
+    def _index_item(self, menu, menu_item):
+        self._endpoints.setdefault(menu_item.endpoint, OrderedDict())[menu.name] = menu_item
+        if menu_item.id_ is not None:
+            self._ids.setdefault(menu_item.id_, OrderedDict())[menu.name] = menu_item
+        self.search_index.add(menu_item)
+
+    def _unindex_item(self, menu, menu_item):
+        for index, key in ((self._endpoints, menu_item.endpoint),
+                           (self._ids, menu_item.id_)):
+            items = index.get(key)
+            if items and items.get(menu.name) is menu_item:
+                del items[menu.name]
+                if not items:
+                    del index[key]
+        self.search_index.remove(menu_item)
 
-    # Private Methods
     def __add_menu_item(self, menu_id, menu_item):
         if not isinstance(menu_item, MenuItem):
             if self.app.debug:
@@ -139,7 +1675,36 @@ class MenuBuilder(object):
         return menu_item
 
 
+if AppGroup is not None:
+    menubuilder_cli = AppGroup('menubuilder', help='Manage the menus.')
+
+    @menubuilder_cli.command('warmup')
+    @click.option('--render', is_flag=True,
+                  help='Render every menu once too.')
+    @click.option('--path', default='/',
+                  help='The page the menus are rendered for, "/" by default.')
+    @click.option('--base-url',
+                  help='The URL root the application is served from, '
+                       'ie, https://example.com/.')
+    def warmup_command(render, path, base_url):
+        """
+        Check the menus and get them ready, reporting the time spent on each.
+        """
+        try:
+            timings = current_app.menubuilder.warmup(
+                render=render, path=path, base_url=base_url
+            )
+        except (RuntimeError, RuntimeWarning) as error:
+            raise click.ClickException(error.args[0])
+        for menu_id, seconds in timings.items():
+            click.echo('{0:<40} {1:>10.2f} ms'.format(menu_id, seconds * 1000))
+else:
+    menubuilder_cli = None
+
+
 class RenderItem(object):
+    __slots__ = ('_classes', '_activewhen', '_visiblewhen', 'html_opts',
+                 'builder', '_fragments')
     __render_params__ = ('class_',)
 
     def __init__(self,
@@ -147,46 +1712,185 @@ class RenderItem(object):
                  visiblewhen=ANYTIME,
                  activewhen=REQUEST_MATCHES_ENDPOINT,
                  **html_opts):
+        self._fragments = None
+        self.classes = classes
+        self._activewhen = activewhen
+        self._visiblewhen = visiblewhen
+        self.html_opts = html_opts or EMPTY_OPTS
+        self.builder = None
+
+    def _get_classes(self):
+        if not self._classes:
+            return []
+        return self._classes.split(' ')
+
+    def _set_classes(self, classes):
         if classes is None or not classes:
             classes = []
         elif isinstance(classes, basestring):
             classes = [classes]
-        self.classes = classes
-        self.activewhen = activewhen
-        self.visiblewhen = visiblewhen
-        self.html_opts = html_opts
+        # Kept as the string that ends up in the class attribute
+        self._classes = ' '.join(set(classes))
+        if self._fragments is not None:
+            self.compile()
+        self._options_changed()
+
+    classes = property(_get_classes, _set_classes)
+
+    def _get_activewhen(self):
+        return self._activewhen
+
+    def _set_activewhen(self, activewhen):
+        self._activewhen = activewhen
+        self._options_changed()
+
+    activewhen = property(_get_activewhen, _set_activewhen)
+
+    def _get_visiblewhen(self):
+        return self._visiblewhen
+
+    def _set_visiblewhen(self, visiblewhen):
+        self._visiblewhen = visiblewhen
+        self._options_changed()
+
+    visiblewhen = property(_get_visiblewhen, _set_visiblewhen)
+
+    def _options_changed(self):
+        # The menu the item is rendered with calls `Menu.changed()`
+        pass
 
     @property
     def class_(self):
-        return '{0} {1}'.format(' '.join(set(self.classes)), self.active_state).strip()
+        return self.class_for(self.active_state)
+
+    def class_for(self, active_state):
+        return (self._classes + ' ' + active_state).strip()
 
     @property
     def active_state(self):
-        if self.activewhen is NEVER:
+        return self.active_state_for()
+
+    def active_state_for(self, context=None):
+        """
+        The active state, evaluating the predicate through the passed
+        :class:`RenderContext`, if any.
+        """
+        activewhen = self.activewhen
+        if activewhen is NEVER:
             return 'inactive'
-        elif self.activewhen is ANYTIME:
-            return 'active'
-        elif callable(self.activewhen) and self.activewhen(self):
+        elif activewhen is ANYTIME:
             return 'active'
+        elif callable(activewhen):
+            if context is None:
+                active = activewhen(self)
+            else:
+                active = context.evaluate(activewhen, self)
+            if active:
+                return 'active'
         return 'inactive'
 
     @property
     def render_params(self):
-        params = self.html_opts.copy()
+        return self.build_render_params()
+
+    def build_render_params(self, **values):
+        params = self.html_opts and self.html_opts.copy() or {}
         for param_name in self.__render_params__:
-            param = getattr(self, param_name, None)
+            if param_name in values:
+                param = values[param_name]
+            else:
+                param = getattr(self, param_name, None)
             if param is not None:
                 params[param_name] = param
         return params
 
+    @property
+    def plain_html_opts(self):
+        """
+        Whether the HTML options are all plain values, strings, numbers or
+        ``None``, rendered the same way for every request, unlike lazy ones.
+        """
+        for value in self.html_opts.values():
+            if value is not None and not isinstance(value, _PLAIN_OPT_TYPES):
+                return False
+        return True
+
+    @property
+    def dependencies(self):
+        if not self.plain_html_opts:
+            return None
+        activewhen = predicate_dependencies(self.activewhen)
+        visiblewhen = predicate_dependencies(self.visiblewhen)
+        if activewhen is None or visiblewhen is None:
+            return None
+        return activewhen | visiblewhen
+
+    def compile(self):
+        """
+        Pre-render the markup for both the active and inactive states, leaving
+        slots for whatever can only be known at request time. Items with lazy
+        HTML options are left to be rendered every time.
+        """
+        if not self.plain_html_opts:
+            self._fragments = None
+            return
+        self._fragments = self.compile_fragments()
+
+    def compile_fragments(self):
+        return dict(
+            (state, _SLOT_RE.split(self.render_markup(state, **self.slots())))
+            for state in ('active', 'inactive')
+        )
+
+    def slots(self):
+        return {}
+
+    def slot_values(self, values):
+        return values
+
+    def render_markup(self, active_state, **values):
+        raise NotImplementedError
+
+    @property
+    def visible(self):
+        return self.is_visible()
+
+    def is_visible(self, context=None):
+        visiblewhen = self.visiblewhen
+        if visiblewhen is NEVER:
+            return False
+        elif callable(visiblewhen):
+            if context is None:
+                return visiblewhen(self) is not False
+            return context.evaluate(visiblewhen, self) is not False
+        return True
+
     def render(self):
-        if self.visiblewhen is NEVER:
-            raise SkipRender
-        elif callable(self.visiblewhen) and self.visiblewhen(self) is False:
+        if not self.visible:
             raise SkipRender
 
 
+class MenuSnapshot(object):
+    """
+    The sorted entries of a menu at a given version. Changes to a menu never
+    alter a snapshot taken, so renders can go through its entries without
+    locking while entries are added or removed from other threads.
+    """
+    __slots__ = ('version', 'entries', 'dependencies', 'endpoint_index')
+
+    def __init__(self, version, entries):
+        self.version = version
+        self.entries = entries
+        # Computed on first use, see `Menu.dependencies`
+        self.dependencies = False
+        # endpoint -> menu item, for the whole tree, on the root menu
+        self.endpoint_index = None
+
+
 class Menu(RenderItem):
+    __slots__ = ('name', 'id_', 'menubuilder', 'parent', 'entries', '_version',
+                 '_snapshot', '_sort_keys', '_sorted_entries', '_lock', 'compiled',
+                 'concurrent', 'lazy')
     __render_params__ = ('id_', 'class_')
 
     def __init__(self,
@@ -195,6 +1899,8 @@ class Menu(RenderItem):
                  classes=None,
                  visiblewhen=ANYTIME,
                  activewhen=ANYTIME,
+                 concurrent=False,
+                 lazy=False,
                  **html_opts):
         super(Menu, self).__init__(
             classes=classes,
@@ -204,7 +1910,28 @@ class Menu(RenderItem):
         )
         self.name = name
         self.id_ = id_
+        self.menubuilder = None
+        # The menu item owning this menu if it's a submenu
+        self.parent = None
         self.entries = {}
+        # Bumped on every change, see `changed()`
+        self._version = 0
+        # Taken on first use after a change, see `snapshot`
+        self._snapshot = None
+        # Held while changing the entries, renders go through the snapshot
+        self._lock = threading.RLock()
+        # Evaluate the entries visibility concurrently, see
+        # `MenuBuilder.evaluate_visibility()`
+        self.concurrent = concurrent
+        # Submenus only rendered within the active trail, loaded from their
+        # fragment URL otherwise, see `MenuBuilder.submenu_url()`
+        self.lazy = lazy
+        # Sorted index of the entries, kept in sync on insert, removal and
+        # priority/title changes so that rendering doesn't have to sort.
+        # Only changed while holding `_lock`, renders use the snapshot's copy.
+        self._sort_keys = []
+        self._sorted_entries = []
+        self.compiled = False
 
     def add_menu_entry(self, title, endpoint, priority=0,
                        activewhen=REQUEST_MATCHES_ENDPOINT,
@@ -224,34 +1951,341 @@ class Menu(RenderItem):
     def add_menu_item(self, menu_item):
         return self.__add_menu_item(menu_item)
 
-    def render(self):
-        super(Menu, self).render()
+    def add_menu_items(self, menu_items):
+        """
+        Add several menu items, sorting the entries only once.
+        """
+        menu_items = list(menu_items)
+        with self._lock:
+            endpoints = set(self.entries)
+            for menu_item in menu_items:
+                if not isinstance(menu_item, MenuItem):
+                    raise RuntimeError(
+                        "The menu item being added is not a MenuItem", type(menu_item)
+                    )
+                if menu_item.endpoint in endpoints:
+                    raise RuntimeError(
+                        "There's already a menu entry for the endpoint %r" %
+                        menu_item.endpoint
+                    )
+                endpoints.add(menu_item.endpoint)
+            for menu_item in menu_items:
+                menu_item.menu = self
+                self._attach(menu_item)
+                self.entries[menu_item.endpoint] = menu_item
+            # sorted() is stable, ties keep their insertion order like _index()
+            self._sorted_entries = sorted(
+                self._sorted_entries + menu_items, key=lambda entry: entry.sort_key
+            )
+            self._sort_keys = [entry.sort_key for entry in self._sorted_entries]
+            self._invalidate()
+        self._propagate_change()
+        return menu_items
+
+    def remove_menu_item(self, endpoint):
+        with self._lock:
+            menu_item = self.entries.pop(endpoint)
+            self._unindex(menu_item)
+            self._detach(menu_item)
+            menu_item.menu = None
+            self._invalidate()
+        self._propagate_change()
+        return menu_item
+
+    @property
+    def root(self):
+        menu = self
+        while menu.parent is not None and menu.parent.menu is not None:
+            menu = menu.parent.menu
+        return menu
+
+    def active_trail(self):
+        """
+        Return the menu items which have the menu item for the current
+        endpoint as a descendant. Costs proportionally to the depth of that
+        menu item, not to the size of the menu tree.
+        """
+        snapshot = self.root.snapshot
+        index = snapshot.endpoint_index
+        if index is None:
+            index = {}
+            pending = [snapshot]
+            while pending:
+                for entry in pending.pop().entries:
+                    index.setdefault(entry.endpoint, entry)
+                    if entry.submenu is not None:
+                        pending.append(entry.submenu.snapshot)
+            snapshot.endpoint_index = index
+        menu_item = index.get(request.endpoint)
+        if menu_item is None:
+            return EMPTY_TRAIL
+        trail = []
+        parent = menu_item.menu.parent
+        while parent is not None:
+            trail.append(parent)
+            parent = parent.menu is not None and parent.menu.parent or None
+        return frozenset(trail)
+
+    def _options_changed(self):
+        # Not while being initialized
+        if getattr(self, '_lock', None) is not None:
+            self.changed()
+
+    def changed(self):
+        """
+        Mark the menu as changed, invalidating any cached output. Entries
+        added, removed or re-sorted and new titles, priorities, classes or
+        predicates, of the menu or of its entries, already call it, call it
+        yourself after changing their other options, ie, ``html_opts``.
+        """
+        self._invalidate()
+        self._propagate_change()
+
+    def _invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._snapshot = None
+
+    def _propagate_change(self):
+        # Called without holding our lock: the parent's writers hold theirs
+        # while attaching this menu, taking ours too would invert the order
+        if self.parent is not None and self.parent.menu is not None:
+            # Submenus are rendered as part of their root menu
+            self.parent.menu.changed()
+        elif self.menubuilder is not None:
+            self.menubuilder._menu_changed(self)
+
+    @property
+    def snapshot(self):
+        """
+        The :class:`MenuSnapshot` of the current version. Only taking a new
+        one, on first use after a change, waits for changes in progress.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._snapshot = MenuSnapshot(
+                        self._version, tuple(self._sorted_entries)
+                    )
+        return snapshot
+
+    @property
+    def version(self):
+        """
+        Bumped on every change, see :meth:`changed`.
+        """
+        return self.snapshot.version
+
+    @property
+    def dependencies(self):
+        """
+        The request attributes, besides the URL root, the rendered menu
+        depends on, or ``None`` if it can't be known, ie, there are opaque
+        predicates, callable contents or lazy titles.
+        """
+        snapshot = self.snapshot
+        if snapshot.dependencies is False:
+            dependencies = RenderItem.dependencies.fget(self)
+            for entry in snapshot.entries:
+                if dependencies is None:
+                    break
+                entry_dependencies = entry.dependencies
+                if entry_dependencies is None:
+                    dependencies = None
+                else:
+                    dependencies = dependencies | entry_dependencies
+            snapshot.dependencies = dependencies
+        return snapshot.dependencies
+
+    def __contains__(self, endpoint):
+        return endpoint in self.entries
+
+    @property
+    def sorted_entries(self):
+        return self.snapshot.entries
+
+    def compile(self):
+        """
+        Compile the menu and all of its entries so that rendering only has to
+        evaluate the predicates, build the URLs and join the pre-rendered
+        fragments. Entries added afterwards are compiled as they're added.
+        Call it again after changing the ``builder`` or an entry's options.
+        """
+        super(Menu, self).compile()
+        for entry in self._current_entries():
+            entry.compile()
+        self.compiled = True
+
+    def slots(self):
+        return {'entries': _slot('entries')}
+
+    def render(self, trail=None, context=None):
+        if not self.is_visible(context):
+            raise SkipRender
+        if trail is None:
+            trail = self.active_trail()
         rendered = []
-        for entry in sorted(self.entries.values()):
+        for entry in self.visible_entries(context):
             try:
-                rendered_entry = entry.render()
+                rendered_entry = entry.render_visible(trail, context)
                 if rendered_entry is not None:
                     rendered.append(rendered_entry)
             except SkipRender:
                 continue
-        return self.builder.ul('\n'.join(rendered), **self.render_params)
+        active_state = self.active_state_for(context)
+        if self._fragments is not None:
+            return _fill_slots(
+                self._fragments[active_state], {'entries': '\n'.join(rendered)}
+            )
+        return self.render_markup(active_state, entries='\n'.join(rendered))
+
+    def iter_render(self, trail=None, context=None):
+        """
+        Generator yielding the menu's markup in chunks, the opening tag, one
+        chunk per entry and the closing tag. Joined they're the same as
+        :meth:`render`'s output.
+        """
+        if not self.is_visible(context):
+            raise SkipRender
+        if trail is None:
+            trail = self.active_trail()
+        active_state = self.active_state_for(context)
+        if self._fragments is not None:
+            fragments = self._fragments[active_state]
+        else:
+            fragments = _SLOT_RE.split(
+                self.render_markup(active_state, entries=_slot('entries'))
+            )
+        opening, _, closing = fragments
+        yield opening
+        separator = u''
+        for entry in self.visible_entries(context):
+            try:
+                rendered_entry = entry.render_visible(trail, context)
+            except SkipRender:
+                continue
+            if rendered_entry is not None:
+                yield separator + rendered_entry
+                separator = u'\n'
+        yield closing
+
+    def to_dict(self, trail=None, context=None):
+        """
+        Return the visible entries as a tree of JSON serializable
+        dictionaries.
+        """
+        if not self.is_visible(context):
+            raise SkipRender
+        if trail is None:
+            trail = self.active_trail()
+        return {
+            'name': self.name,
+            'id': self.id_,
+            'classes': self.classes,
+            'active': self.active_state_for(context) == 'active',
+            'entries': [
+                entry.to_dict(trail, context)
+                for entry in self.visible_entries(context)
+            ]
+        }
+
+    def visible_entries(self, context=None):
+        """
+        Iterate over the sorted entries which are visible.
+        """
+        entries = self.snapshot.entries
+        menubuilder = self.menubuilder
+        if self.concurrent and menubuilder is not None:
+            entries = list(entries)
+            visibility = menubuilder.evaluate_visibility(entries, context)
+            for entry, visible in zip(entries, visibility):
+                if visible:
+                    yield entry
+            return
+        for entry in entries:
+            if entry.is_visible(context):
+                yield entry
+
+    def render_markup(self, active_state, entries):
+        return self.builder.ul(
+            entries, **self.build_render_params(class_=self.class_for(active_state))
+        )
 
     def __add_menu_item(self, menu_item):
         if not isinstance(menu_item, MenuItem):
             raise RuntimeError(
                 "The menu item being added is not a MenuItem", type(menu_item)
             )
-        if menu_item.endpoint in self.entries:
-            raise RuntimeError(
-                "There's already a menu entry for the endpoint %r" %
-                menu_item.endpoint, self.entries[menu_item.endpoint]
-            )
-        menu_item.builder = self.builder
-        self.entries[menu_item.endpoint] = menu_item
+        with self._lock:
+            if menu_item.endpoint in self.entries:
+                raise RuntimeError(
+                    "There's already a menu entry for the endpoint %r" %
+                    menu_item.endpoint, self.entries[menu_item.endpoint]
+                )
+            menu_item.menu = self
+            self._attach(menu_item)
+            self.entries[menu_item.endpoint] = menu_item
+            self._index(menu_item)
+            self._invalidate()
+        self._propagate_change()
         return menu_item
 
+    def _attach(self, menu_item):
+        menu_item.builder = self.builder
+        if self.menubuilder is not None:
+            self.menubuilder._index_item(self.root, menu_item)
+            if self.menubuilder.instrumentation.enabled:
+                self.menubuilder.instrumentation.instrument(menu_item)
+        submenu = menu_item.submenu
+        if submenu is not None:
+            submenu.builder = self.builder
+            submenu.menubuilder = self.menubuilder
+            for entry in submenu._current_entries():
+                submenu._attach(entry)
+        if self.compiled:
+            menu_item.compile()
+
+    def _detach(self, menu_item):
+        if self.menubuilder is not None:
+            self.menubuilder._unindex_item(self.root, menu_item)
+        if menu_item.submenu is not None:
+            for entry in menu_item.submenu._current_entries():
+                menu_item.submenu._detach(entry)
+
+    def _current_entries(self):
+        # Copying the list is atomic, unlike ``snapshot`` it doesn't take our
+        # lock, which the parent menu's writers can't while holding theirs
+        return tuple(self._sorted_entries)
+
+    def _index(self, menu_item):
+        key = menu_item.sort_key
+        idx = bisect_right(self._sort_keys, key)
+        self._sort_keys.insert(idx, key)
+        self._sorted_entries.insert(idx, menu_item)
+
+    def _unindex(self, menu_item):
+        for idx, entry in enumerate(self._sorted_entries):
+            if entry is menu_item:
+                del self._sort_keys[idx]
+                del self._sorted_entries[idx]
+                return
+
+    def _reindex(self, menu_item):
+        with self._lock:
+            self._unindex(menu_item)
+            self._index(menu_item)
+            if self.menubuilder is not None:
+                # The title is searched
+                self.menubuilder.search_index.add(menu_item)
+            self._invalidate()
+        self._propagate_change()
+
 
 class MenuItem(RenderItem):
+    __slots__ = ('menu', 'id_', '_title', 'endpoint', '_priority', 'li_classes',
+                 'submenu')
     __render_params__ = ('id_', 'class_', 'href')
 
     def __init__(self,
@@ -270,38 +2304,240 @@ class MenuItem(RenderItem):
             visiblewhen=visiblewhen,
             **html_opts
         )
+        self.menu = None
         self.id_ = id_
         self.title = title
         self.endpoint = endpoint
         self.priority = priority
         self.li_classes = li_classes
+        self.submenu = None
 
-    def render(self):
-        super(MenuItem, self).render()
+    def add_submenu(self, id_=None, classes=None, visiblewhen=ANYTIME,
+                    activewhen=ANYTIME, lazy=False, **html_opts):
+        """
+        Create the child menu of this item, rendered as a nested ``ul``. A
+        `lazy` submenu is only rendered for the pages within it, other pages
+        get an empty ``<ul class="lazy">`` placeholder whose ``data-fragment``
+        attribute is the URL of its markup, see :meth:`MenuBuilder.submenu_url`.
+        """
+        if self.submenu is not None:
+            raise RuntimeError(
+                "There's already a submenu for the endpoint %r" % self.endpoint
+            )
+        submenu = Menu(
+            self.endpoint, id_=id_, classes=classes, visiblewhen=visiblewhen,
+            activewhen=activewhen, lazy=lazy, **html_opts
+        )
+        submenu.parent = self
+        self.submenu = submenu
+        if self.menu is not None:
+            with self.menu._lock:
+                self.menu._attach(self)
+                self.menu._invalidate()
+            self.menu._propagate_change()
+        return submenu
+
+    def _get_title(self):
+        return self._title
+
+    def _set_title(self, title):
+        self._title = title
+        if self._fragments is not None:
+            self.compile()
+        self._sort_key_changed()
+
+    title = property(_get_title, _set_title)
+
+    def _get_priority(self):
+        return self._priority
+
+    def _set_priority(self, priority):
+        self._priority = priority
+        self._sort_key_changed()
+
+    priority = property(_get_priority, _set_priority)
+
+    @property
+    def sort_key(self):
+        return (self._priority, self._title)
+
+    @property
+    def dependencies(self):
+        if not isinstance(self.title, basestring):
+            return None
+        return self._with_submenu_dependencies(super(MenuItem, self).dependencies)
+
+    def _with_submenu_dependencies(self, dependencies):
+        if dependencies is None or self.submenu is None:
+            return dependencies
+        submenu_dependencies = self.submenu.dependencies
+        if submenu_dependencies is None:
+            return None
+        if self.submenu.lazy:
+            # The fragment URL of the placeholder has the page path
+            submenu_dependencies = submenu_dependencies | frozenset(['path'])
+        # The active trail depends on the endpoint
+        return dependencies | submenu_dependencies | frozenset(['endpoint'])
+
+    def _sort_key_changed(self):
+        menu = getattr(self, 'menu', None)
+        if menu is not None:
+            menu._reindex(self)
+
+    def _options_changed(self):
+        menu = getattr(self, 'menu', None)
+        if menu is not None:
+            menu.changed()
+
+    @property
+    def translated(self):
+        """
+        Whether the title, and so the ``alt`` and ``title`` attributes, is a
+        lazy string, ie, a translation, rendered differently per locale.
+        """
+        title = self.title
+        return title is not None and not isinstance(title, basestring)
+
+    def compile(self):
+        if self.submenu is not None:
+            self.submenu.compile()
+        # Lazy strings, ie, translations, are compiled once per locale
+        if not isinstance(self.title, basestring):
+            self._fragments = None
+            return
+        super(MenuItem, self).compile()
+
+    def slots(self):
+        slots = {'href': _slot('href')}
+        if self.submenu is not None:
+            slots.update(li_class=_slot('li_class'), submenu=_slot('submenu'))
+        return slots
+
+    def render_values(self, active_state, trail, context=None):
+        """
+        The values which can only be known at request time.
+        """
+        if context is None:
+            values = {'href': self.href}
+        else:
+            values = {'href': context.href(self)}
+        if self.submenu is not None:
+            values['li_class'] = self.li_class_for(active_state, self in trail)
+            if self.collapsed(active_state, trail):
+                values['submenu'] = self.builder.ul(class_='lazy', **{
+                    'data-fragment': self.menu.menubuilder.submenu_url(self)
+                })
+            else:
+                try:
+                    values['submenu'] = self.submenu.render(trail, context)
+                except SkipRender:
+                    values['submenu'] = None
+        return values
+
+    def collapsed(self, active_state, trail):
+        """
+        Whether the submenu is lazy and left to be loaded from its fragment
+        URL, ie, the current page isn't this item's or within its submenu.
+        """
+        return self.submenu.lazy and active_state != 'active' and self not in trail
+
+    def slot_values(self, values):
+        slot_values = {}
+        for name, value in values.items():
+            if name in ('href', 'li_class'):
+                value = _escape(value)
+            elif value is None:
+                value = u''
+            else:
+                value = unicode(value)
+            slot_values[name] = value
+        return slot_values
+
+    def render(self, trail=EMPTY_TRAIL, context=None):
+        if not self.is_visible(context):
+            raise SkipRender
+        return self.render_visible(trail, context)
+
+    def render_visible(self, trail=EMPTY_TRAIL, context=None):
+        """
+        Render without checking the visibility, already done by the caller.
+        """
+        active_state = self.active_state_for(context)
+        values = self.render_values(active_state, trail, context)
+        fragments = self._fragments
+        if fragments is None and self.translated and self.menu is not None and \
+                self.menu.menubuilder is not None:
+            # Translated titles are compiled once per locale
+            fragments = self.menu.menubuilder.locale_fragments(self)
+        if fragments is not None:
+            return _fill_slots(fragments[active_state], self.slot_values(values))
+        return self.render_markup(active_state, **values)
+
+    def to_dict(self, trail=EMPTY_TRAIL, context=None):
+        """
+        Return the item, whose visibility was already checked, as a JSON
+        serializable dictionary.
+        """
+        data = {
+            'title': self.title is not None and unicode(self.title) or None,
+            'endpoint': self.endpoint,
+            'href': self.href if context is None else context.href(self),
+            'id': self.id_,
+            'classes': self.classes,
+            'active': self.active_state_for(context) == 'active',
+            'active_trail': self in trail,
+            'entries': None,
+        }
+        if self.submenu is None:
+            return data
+        if self.collapsed(data['active'] and 'active' or 'inactive', trail):
+            data['fragment'] = self.menu.menubuilder.submenu_url(self, 'json')
+            return data
+        try:
+            data['entries'] = self.submenu.to_dict(trail, context)['entries']
+        except SkipRender:
+            pass
+        return data
+
+    def li_class_for(self, active_state, in_trail=False):
+        return ' '.join(filter(None, [
+            self.li_classes, active_state, in_trail and 'active-trail' or None
+        ]))
+
+    def render_markup(self, active_state, href, li_class=None, submenu=None):
+        if li_class is None:
+            li_class = self.li_class_for(active_state)
         return self.builder.li(
             self.builder.a(
-                self.title, **self.render_params
+                self.title, **self.build_render_params(
+                    class_=self.class_for(active_state), href=href
+                )
             ),
-            class_=' '.join(filter(None, [self.li_classes, self.active_state]))
+            submenu,
+            class_=li_class
         )
 
     @property
     def href(self):
+        menu = self.menu
+        if menu is not None and menu.menubuilder is not None:
+            return menu.menubuilder.url_for(self.endpoint)
         return url_for(self.endpoint)
 
     def __lt__(self, other):
-        if self.priority == other.priority:
-            return self.title < other.title
-        return self.priority < other.priority
+        return self.sort_key < other.sort_key
 
     def __unicode__(self):
-        return u'<MenuItem title="%(title)s" endpoint="%(endpoint)s" priority=%(priority)s>' % self.__dict__
+        return u'<MenuItem title="%s" endpoint="%s" priority=%s>' % (
+            self.title, self.endpoint, self.priority
+        )
 
     def __repr__(self):
         return self.__unicode__().encode('utf-8')
 
 
 class MenuItemContent(MenuItem):
+    __slots__ = ('content', 'is_link')
     __render_params__ = ('id_', 'class_', 'href')
 
     def __init__(self, content, title=None, endpoint=None, priority=0,
@@ -320,22 +2556,78 @@ class MenuItemContent(MenuItem):
     @property
     def href(self):
         if self.is_link:
-            return url_for(self.endpoint)
+            return MenuItem.href.fget(self)
 
-    def render(self):
-        super(MenuItemContent, self).render()
+    @property
+    def translated(self):
+        content = self.content
+        return super(MenuItemContent, self).translated or (
+            content is not None and not callable(content) and
+            not isinstance(content, basestring)
+        )
+
+    def compile(self):
+        if self.submenu is not None:
+            self.submenu.compile()
+        if self.title is not None and not isinstance(self.title, basestring):
+            self._fragments = None
+            return
+        if not callable(self.content) and not isinstance(self.content, basestring):
+            self._fragments = None
+            return
+        RenderItem.compile(self)
+
+    @property
+    def dependencies(self):
+        if self.title is not None and not isinstance(self.title, basestring):
+            return None
+        if callable(self.content):
+            return None
+        return self._with_submenu_dependencies(RenderItem.dependencies.fget(self))
+
+    def slots(self):
+        slots = super(MenuItemContent, self).slots()
+        slots['content'] = self.content
+        if not self.is_link:
+            slots['href'] = None
+        if callable(self.content):
+            slots['content'] = _slot('content')
+        return slots
+
+    def render_values(self, active_state, trail, context=None):
+        values = super(MenuItemContent, self).render_values(
+            active_state, trail, context
+        )
+        content = self.content
+        if callable(content):
+            content = content(self)
+        values['content'] = content
+        return values
+
+    def to_dict(self, trail=EMPTY_TRAIL, context=None):
+        data = super(MenuItemContent, self).to_dict(trail, context)
+        content = self.content
+        if callable(content):
+            content = content(self)
+        data['content'] = content is not None and unicode(content) or None
+        data['is_link'] = self.is_link
+        return data
 
-        render_params = self.render_params
+    def render_markup(self, active_state, href, content, li_class=None,
+                      submenu=None):
+        render_params = self.build_render_params(
+            class_=self.class_for(active_state), href=href
+        )
         if self.is_link:
             if self.title:
                 render_params['alt'] = render_params['title'] = self.title
             element = self.builder.a
         else:
             element = self.builder.span
-        content = self.content
-        if callable(content):
-            content = content(self)
+        if li_class is None:
+            li_class = self.li_class_for(active_state)
         return self.builder.li(
             element(content, **render_params),
-            class_=' '.join(filter(None, [self.li_classes, self.active_state]))
+            submenu,
+            class_=li_class
         )
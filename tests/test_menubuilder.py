@@ -7,10 +7,25 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-import werkzeug.utils
-from flask import Flask, request
-from flask.ext.menubuilder import MenuBuilder
+from flask import Blueprint, Flask, request, render_template_string
+from jinja2 import Markup, TemplateSyntaxError
+from flask.ext.menubuilder import (
+    MenuBuilder, MenuItem, MenuItemContent, EndpointIn, PathPrefix, ViewArgEquals,
+    menu_render_started, menu_rendered, shared_predicate, Predicate, MarkupBuilder
+)
+
+try:
+    from werkzeug.utils import html as werkzeug_html, xhtml as werkzeug_xhtml
+except ImportError:
+    # Not in recent werkzeug releases
+    werkzeug_html = werkzeug_xhtml = None
 
 
 class MenuBuilderTestCase(unittest.TestCase):
@@ -108,7 +123,7 @@ class MenuBuilderTestCase(unittest.TestCase):
         self.assertRaises(RuntimeError, lambda: self.menubuilder.add_menu_item('main', WrongType()))
 
     def test_render_ul_xhtml(self):
-        self.menubuilder.builder = getattr(werkzeug.utils, 'xhtml')
+        self.menubuilder.builder = werkzeug_xhtml or MarkupBuilder('xhtml')
         with self.app.test_request_context('/'):
             output = self.menubuilder.render('main')
             self.assertEqual(str(output), """\
@@ -116,6 +131,1001 @@ class MenuBuilderTestCase(unittest.TestCase):
 <li class="inactive"><a class="inactive" href="/one">One</a></li>
 <li class="inactive"><a class="inactive" href="/two">Two</a></li></ul>""")
 
+    def test_priority_change_reorders_entries(self):
+        self.menubuilder.menus['main'].entries['two'].priority = -2
+        with self.app.test_request_context('/'):
+            output = self.menubuilder.render('main')
+            self.assertEqual(str(output), """\
+<ul class="active"><li class="inactive"><a class="inactive" href="/two">Two</a></li>
+<li class="active"><a class="active" href="/">Root</a></li>
+<li class="inactive"><a class="inactive" href="/one">One</a></li></ul>""")
+
+    def test_remove_menu_item(self):
+        self.menubuilder.menus['main'].remove_menu_item('one')
+        with self.app.test_request_context('/'):
+            output = self.menubuilder.render('main')
+            self.assertEqual(str(output), """\
+<ul class="active"><li class="active"><a class="active" href="/">Root</a></li>
+<li class="inactive"><a class="inactive" href="/two">Two</a></li></ul>""")
+
+    def test_compiled_render_matches_render(self):
+        def build_menu(format):
+            menubuilder = MenuBuilder(self.app, format=format)
+            menubuilder.add_menu('main', id_='nav', classes=['nav', 'top'])
+            menubuilder.add_menu_entry('main', "Root", "root", priority=-1,
+                                       rel='<home & away>', target='_blank')
+            menubuilder.add_menu_entry('main', "One", "one", li_classes='first')
+            menubuilder.add_menu_entry(
+                'main', "Visible under /visible only", "visible",
+                visiblewhen=lambda mi: request.path == '/visible'
+            )
+            menubuilder.add_menu_item('main', MenuItemContent(
+                lambda mi: '<b>%s</b>' % request.path, title='Path', endpoint='two'
+            ))
+            menubuilder.add_menu_item('main', MenuItemContent(
+                'Static', endpoint='static-span', is_link=False, priority=5
+            ))
+            return menubuilder
+
+        for format in ('html', 'xhtml'):
+            menubuilder = build_menu(format)
+            compiled = build_menu(format)
+            compiled.compile()
+            for path in ('/', '/one', '/visible'):
+                with self.app.test_request_context(path):
+                    self.assertEqual(
+                        compiled.render('main'), menubuilder.render('main')
+                    )
+
+    def test_compiled_menu_picks_up_new_entries(self):
+        self.menubuilder.compile('main')
+        self.menubuilder.add_menu_entry('main', "Three", "three", priority=1)
+
+        @self.app.route('/three')
+        def three():
+            pass
+
+        with self.app.test_request_context('/three'):
+            output = self.menubuilder.render('main')
+            self.assertEqual(str(output), """\
+<ul class="active"><li class="inactive"><a class="inactive" href="/">Root</a></li>
+<li class="inactive"><a class="inactive" href="/one">One</a></li>
+<li class="inactive"><a class="inactive" href="/two">Two</a></li>
+<li class="active"><a class="active" href="/three">Three</a></li></ul>""")
+
+    def test_hrefs_are_memoized_per_url_root(self):
+        with self.app.test_request_context('/'):
+            self.menubuilder.render('main')
+        self.assertEqual(len(self.menubuilder.href_cache), 3)
+        self.assertTrue(('one', 'http://localhost/') in self.menubuilder.href_cache)
+
+        with self.app.test_request_context('/', base_url='https://example.com/app'):
+            self.assertEqual(self.menubuilder.url_for('one'), '/app/one')
+        self.assertEqual(len(self.menubuilder.href_cache), 4)
+
+        self.menubuilder.invalidate_hrefs('one')
+        self.assertEqual(len(self.menubuilder.href_cache), 2)
+        self.menubuilder.invalidate_hrefs()
+        self.assertEqual(len(self.menubuilder.href_cache), 0)
+
+        # Outside of requests URLs are built, not memoized, from SERVER_NAME
+        self.app.config['SERVER_NAME'] = 'example.com'
+        with self.app.app_context():
+            self.assertEqual(self.menubuilder.menus['main'].entries['one'].href,
+                             'http://example.com/one')
+        self.assertEqual(len(self.menubuilder.href_cache), 0)
+
+    def test_relative_hrefs_are_memoized_per_blueprint(self):
+        for name in ('a', 'b'):
+            blueprint = Blueprint(name, __name__)
+            blueprint.add_url_rule('/index', 'index', lambda: None)
+            self.app.register_blueprint(blueprint, url_prefix='/' + name)
+        self.menubuilder.add_menu('section')
+        self.menubuilder.add_menu_entry('section', "Section home", '.index')
+        for name in ('a', 'b'):
+            with self.app.test_request_context('/{0}/index'.format(name)):
+                self.assertTrue('href="/{0}/index"'.format(name)
+                                in self.menubuilder.render('section'))
+
+    def test_href_cache_is_bounded(self):
+        self.menubuilder.href_cache.maxsize = 2
+        with self.app.test_request_context('/'):
+            self.menubuilder.render('main')
+        self.assertEqual(len(self.menubuilder.href_cache), 2)
+        self.assertFalse(('root', 'http://localhost/') in self.menubuilder.href_cache)
+
+    def test_endpoint_and_id_lookups(self):
+        self.menubuilder.add_menu('footer')
+        self.menubuilder.add_menu_entry('footer', "One", "one", id_='footer-one')
+        self.assertTrue(self.menubuilder.has_menu_endpoint('one'))
+        self.assertTrue(self.menubuilder.has_menu_endpoint('one', 'footer'))
+        self.assertFalse(self.menubuilder.has_menu_endpoint('two', 'footer'))
+        self.assertFalse(self.menubuilder.has_menu_endpoint('missing'))
+        self.assertEqual(
+            sorted(menu.name for menu in self.menubuilder.menus_for_endpoint('one')),
+            ['footer', 'main']
+        )
+        self.assertEqual(len(self.menubuilder.items_for_endpoint('one')), 2)
+
+        item = self.menubuilder.get_item_by_id('footer-one')
+        self.assertTrue(item is self.menubuilder.menus['footer'].entries['one'])
+        self.assertTrue(self.menubuilder.has_item_by_id('footer-one', 'footer'))
+        self.assertFalse(self.menubuilder.has_item_by_id('footer-one', 'main'))
+
+        self.menubuilder.menus['footer'].remove_menu_item('one')
+        self.assertFalse(self.menubuilder.has_item_by_id('footer-one'))
+        self.assertFalse(self.menubuilder.has_menu_endpoint('one', 'footer'))
+        self.assertTrue(self.menubuilder.has_menu_endpoint('one'))
+
+    def test_render_cache(self):
+        menubuilder = MenuBuilder(self.app, render_cache_size=10)
+        menubuilder.add_menu('plain')
+        menubuilder.add_menu_entry('plain', "Root", "root")
+        menubuilder.add_menu_entry('plain', "One", "one")
+        menubuilder.add_menu('custom')
+        menubuilder.add_menu_entry('custom', "Root", "root",
+                                   activewhen=lambda mi: True)
+
+        with self.app.test_request_context('/'):
+            output = menubuilder.render('plain')
+            self.assertTrue(menubuilder.render('plain') is output)
+            menubuilder.render('custom')
+        with self.app.test_request_context('/one'):
+            self.assertEqual(str(menubuilder.render('plain')), """\
+<ul class="active"><li class="active"><a class="active" href="/one">One</a></li>
+<li class="inactive"><a class="inactive" href="/">Root</a></li></ul>""")
+        self.assertEqual(len(menubuilder.render_cache), 2)
+
+        menubuilder.add_menu_entry('plain', "Two", "two")
+        self.assertEqual(len(menubuilder.render_cache), 0)
+        with self.app.test_request_context('/one'):
+            self.assertTrue('/two' in menubuilder.render('plain'))
+
+        # Changed predicates and classes invalidate the cached output
+        two = menubuilder.menus['plain'].entries['two']
+        two.classes = 'new'
+        with self.app.test_request_context('/one'):
+            self.assertTrue('class="new inactive"' in menubuilder.render('plain'))
+        two.visiblewhen = lambda mi: request.path != '/one'
+        self.assertTrue(menubuilder.menus['plain'].dependencies is None)
+        with self.app.test_request_context('/one'):
+            self.assertFalse('/two' in menubuilder.render('plain'))
+
+    def test_declarative_predicates(self):
+        @self.app.route('/page/', defaults={'name': 'about'})
+        @self.app.route('/page/<name>')
+        def page(name):
+            pass
+
+        menubuilder = MenuBuilder(self.app, render_cache_size=10)
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', "Root", "root",
+                                   activewhen=EndpointIn('root', 'one'))
+        menubuilder.add_menu_entry('main', "About", "page",
+                                   activewhen=ViewArgEquals('name', 'about'),
+                                   visiblewhen=PathPrefix('/page/'))
+        self.assertEqual(
+            menubuilder.menus['main'].dependencies,
+            frozenset(['endpoint', 'path', 'view_args'])
+        )
+
+        with self.app.test_request_context('/one'):
+            self.assertEqual(str(menubuilder.render('main')), """\
+<ul class="active"><li class="active"><a class="active" href="/">Root</a></li></ul>""")
+        with self.app.test_request_context('/page/'):
+            self.assertEqual(str(menubuilder.render('main')), """\
+<ul class="active"><li class="active"><a class="active" href="/page/">About</a></li>
+<li class="inactive"><a class="inactive" href="/">Root</a></li></ul>""")
+        with self.app.test_request_context('/page/other'):
+            self.assertTrue('<li class="inactive"><a class="inactive" href="/page/">'
+                            in menubuilder.render('main'))
+        self.assertEqual(len(menubuilder.render_cache), 3)
+
+        menubuilder.add_menu_entry('main', "Two", "two",
+                                   visiblewhen=lambda mi: True)
+        self.assertTrue(menubuilder.menus['main'].dependencies is None)
+
+        # Lazy HTML options, ie, translated, are rendered for each request
+        class LazyString(object):
+            def __unicode__(self):
+                return request.args.get('tip', u'')
+
+        menubuilder = MenuBuilder(self.app, render_cache_size=10)
+        menubuilder.add_menu('tips')
+        menubuilder.add_menu_entry('tips', "Root", "root", tabindex=1,
+                                   rel=LazyString())
+        self.assertTrue(menubuilder.menus['tips'].dependencies is None)
+        menubuilder.compile()
+        self.assertTrue(menubuilder.menus['tips'].entries['root']._fragments is None)
+        for tip in ('one', 'two'):
+            with self.app.test_request_context('/?tip=' + tip):
+                self.assertTrue('rel="{0}"'.format(tip) in menubuilder.render('tips'))
+
+    def test_submenus(self):
+        @self.app.route('/admin/users')
+        def users():
+            pass
+
+        @self.app.route('/admin/users/new')
+        def new_user():
+            pass
+
+        one = self.menubuilder.menus['main'].entries['one']
+        submenu = one.add_submenu(classes='sub')
+        submenu.add_menu_entry("Users", "users").add_submenu().add_menu_entry(
+            "New", "new_user"
+        )
+        self.assertTrue(self.menubuilder.has_menu_endpoint('new_user', 'main'))
+
+        expected = """\
+<ul class="active"><li class="inactive"><a class="inactive" href="/">Root</a></li>
+<li class="inactive active-trail"><a class="inactive" href="/one">One</a>\
+<ul class="sub active"><li class="inactive active-trail"><a class="inactive" href="/admin/users">Users</a>\
+<ul class="active"><li class="active"><a class="active" href="/admin/users/new">New</a></li></ul></li></ul></li>
+<li class="inactive"><a class="inactive" href="/two">Two</a></li></ul>"""
+        with self.app.test_request_context('/admin/users/new'):
+            self.assertEqual(str(self.menubuilder.render('main')), expected)
+            self.menubuilder.compile()
+            self.assertEqual(str(self.menubuilder.render('main')), expected)
+        with self.app.test_request_context('/one'):
+            self.assertTrue('<li class="active"><a class="active" href="/one">'
+                            in self.menubuilder.render('main'))
+
+        self.menubuilder.menus['main'].remove_menu_item('one')
+        self.assertFalse(self.menubuilder.has_menu_endpoint('new_user'))
+
+    def test_stream(self):
+        with self.app.test_request_context('/visible'):
+            expected = self.menubuilder.render('main')
+            chunks = list(self.menubuilder.stream('main'))
+            self.assertEqual(len(chunks), 6)
+            self.assertEqual(''.join(chunks), expected)
+            self.menubuilder.compile()
+            self.assertEqual(''.join(self.menubuilder.stream('main')), expected)
+
+    def test_menu_tag(self):
+        with self.app.test_request_context('/one'):
+            self.assertEqual(
+                render_template_string('<nav>{% menu "main" %}</nav>'),
+                '<nav>%s</nav>' % self.menubuilder.render('main')
+            )
+            self.assertRaises(
+                TemplateSyntaxError,
+                lambda: render_template_string('{% menu "missing" %}')
+            )
+
+    def test_menu_tag_without_context_processor(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app, context_processor=False)
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', "Root", "root")
+        app.add_url_rule('/', 'root')
+        with app.test_request_context('/'):
+            self.assertEqual(
+                render_template_string(
+                    '{{ menubuilder is defined }} {% menu "main" %}'
+                ),
+                'False <ul class="active"><li class="active">'
+                '<a class="active" href="/">Root</a></li></ul>'
+            )
+
+    def test_add_menu_entries(self):
+        self.menubuilder.add_menu('footer')
+        self.menubuilder.add_menu_entries('footer', [
+            {'title': "Two", 'endpoint': "two"},
+            MenuItem("One", "one"),
+            {'title': "Root", 'endpoint': "root", 'priority': -1,
+             'submenu': {'entries': [{'title': "Visible", 'endpoint': "visible"}]}},
+        ])
+        self.assertEqual(
+            [entry.endpoint for entry in self.menubuilder.menus['footer'].sorted_entries],
+            ['root', 'one', 'two']
+        )
+        self.assertTrue(self.menubuilder.has_menu_endpoint('visible', 'footer'))
+
+    def test_add_menu_entries_reports_all_errors(self):
+        try:
+            self.menubuilder.add_menu_entries('main', [
+                {'title': "Root", 'endpoint': "root"},
+                {'title': "Missing", 'endpoint': "missing"},
+                {'title': "Bad", 'endpoint': "bad", 'unknown': True},
+                {'title': "Three", 'endpoint': "three"},
+                {'title': "Three", 'endpoint': "three"},
+            ])
+        except RuntimeWarning as err:
+            self.assertEqual(len(err.args[1]), 6)
+        else:
+            self.fail('RuntimeWarning not raised')
+        self.assertEqual(len(self.menubuilder.menus['main'].entries), 4)
+
+    def test_load_menus(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'menus.json')
+            with open(filename, 'w') as fp:
+                json.dump({
+                    'footer': {'classes': 'footer', 'entries': [
+                        {'title': "One", 'endpoint': "one"},
+                        {'title': "Two", 'endpoint': "two"},
+                    ]},
+                    'main': {'entries': [
+                        {'title': "Zero", 'endpoint': "zero"},
+                    ]},
+                }, fp)
+            self.assertRaises(
+                RuntimeWarning, lambda: self.menubuilder.load_menus(filename)
+            )
+            self.assertFalse(self.menubuilder.has_menu('footer'))
+            self.menubuilder.load_menus(filename, check_endpoints=False)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertTrue('zero' in self.menubuilder.menus['main'])
+        with self.app.test_request_context('/one'):
+            self.assertEqual(str(self.menubuilder.render('footer')), """\
+<ul class="footer active"><li class="active"><a class="active" href="/one">One</a></li>
+<li class="inactive"><a class="inactive" href="/two">Two</a></li></ul>""")
+
+    def test_instrumentation(self):
+        events = []
+
+        def started(sender, menu_id):
+            events.append(('started', menu_id))
+
+        def rendered(sender, menu_id, duration):
+            events.append(('rendered', menu_id))
+
+        menu_render_started.connect(started)
+        menu_rendered.connect(rendered)
+        try:
+            self.menubuilder.instrumentation.enable()
+            with self.app.test_request_context('/'):
+                self.menubuilder.render('main')
+                self.menubuilder.render('main')
+            self.menubuilder.instrumentation.disable()
+            with self.app.test_request_context('/'):
+                self.menubuilder.render('main')
+        finally:
+            menu_render_started.disconnect(started)
+            menu_rendered.disconnect(rendered)
+
+        self.assertEqual(events, [('started', 'main'), ('rendered', 'main')] * 3)
+        stats = self.menubuilder.instrumentation.as_dict()
+        self.assertEqual(stats['renders']['main']['count'], 2)
+        self.assertEqual(sum(stats['renders']['main']['buckets'].values()), 2)
+        self.assertEqual(stats['predicates']['main:one']['activewhen']['calls'], 2)
+        self.assertEqual(stats['predicates']['main:visible']['visiblewhen']['false'], 2)
+        self.assertFalse(hasattr(
+            self.menubuilder.menus['main'].entries['one'].activewhen, 'predicate'
+        ))
+
+    def test_shared_predicates(self):
+        calls = []
+
+        @shared_predicate
+        def is_admin(menu_item):
+            calls.append(menu_item)
+            return request.args.get('admin') == '1'
+
+        self.menubuilder.add_menu('admin', visiblewhen=is_admin)
+        for name in ('one', 'two'):
+            self.menubuilder.add_menu_entry('admin', name, name, visiblewhen=is_admin)
+            self.menubuilder.menus['main'].entries[name].visiblewhen = is_admin
+
+        with self.app.test_request_context('/?admin=1'):
+            self.assertTrue('/one' in self.menubuilder.render('main'))
+            self.assertTrue('/two' in self.menubuilder.render('admin'))
+            self.assertEqual(len(calls), 1)
+            self.app.do_teardown_request()
+        with self.app.test_request_context('/'):
+            self.assertFalse('/one' in self.menubuilder.render('main'))
+            self.assertEqual(len(calls), 2)
+
+    def test_concurrent_visibility_predicates(self):
+        threads = set()
+
+        def slow_check(menu_item):
+            threads.add(threading.current_thread().ident)
+            time.sleep(0.05)
+            return request.path != '/' + menu_item.endpoint
+
+        self.menubuilder.add_menu('concurrent', concurrent=True)
+        self.menubuilder.add_menu('sequential')
+        for menu_id in ('concurrent', 'sequential'):
+            for endpoint in ('root', 'one', 'two', 'visible'):
+                self.menubuilder.add_menu_entry(
+                    menu_id, endpoint.title(), endpoint, visiblewhen=slow_check
+                )
+        with self.app.test_request_context('/two'):
+            output = self.menubuilder.render('concurrent')
+            self.assertEqual(output, self.menubuilder.render('sequential'))
+        self.assertFalse('/two' in output)
+        self.assertTrue(len(threads) > 1)
+
+        # Forked processes get their own pool
+        pool = self.menubuilder.predicate_pool
+        self.menubuilder._predicate_pool_pid = -1
+        self.assertFalse(self.menubuilder.predicate_pool is pool)
+        self.assertEqual(self.menubuilder._predicate_pool_pid, os.getpid())
+
+    def test_warmup_without_predicate_pool(self):
+        self.menubuilder.add_menu('concurrent', concurrent=True)
+        for endpoint in ('root', 'one', 'two'):
+            self.menubuilder.add_menu_entry(
+                'concurrent', endpoint.title(), endpoint,
+                visiblewhen=lambda menu_item: True
+            )
+        self.menubuilder.warmup(render=True)
+        # Would be inherited, unusable, by forked workers
+        self.assertEqual(self.menubuilder._predicate_pool, None)
+
+    def test_render_many(self):
+        calls = []
+
+        class IsRoot(Predicate):
+            item_independent = True
+
+            def __call__(self, menu_item):
+                calls.append(menu_item)
+                return request.path == '/'
+
+        is_root = IsRoot()
+        self.menubuilder.add_menu('footer')
+        for menu_id in ('main', 'footer'):
+            self.menubuilder.add_menu_entry(menu_id, "Three", "three",
+                                            visiblewhen=is_root)
+        self.app.add_url_rule('/three', 'three')
+        self.menubuilder.add_menu_entry('footer', "One", "one")
+
+        with self.app.test_request_context('/'):
+            expected = dict(
+                (menu_id, self.menubuilder.render(menu_id))
+                for menu_id in ('main', 'footer')
+            )
+            del calls[:]
+            rendered = self.menubuilder.render_many(['main', 'footer'])
+            self.assertEqual(list(rendered.keys()), ['main', 'footer'])
+            self.assertEqual(dict(rendered), expected)
+            self.assertEqual(len(calls), 1)
+
+        # A span for an endpoint also linked to gets no href
+        self.menubuilder.add_menu('side')
+        self.menubuilder.add_menu_item('side', MenuItemContent(
+            'Static', endpoint='one', is_link=False
+        ))
+        with self.app.test_request_context('/'):
+            rendered = self.menubuilder.render_many(['footer', 'side'])
+            self.assertEqual(rendered['side'], self.menubuilder.render('side'))
+            self.assertFalse('href' in rendered['side'])
+
+        # Instrumented predicates are shared as the ones they wrap
+        self.menubuilder.instrumentation.enable()
+        with self.app.test_request_context('/'):
+            del calls[:]
+            self.assertEqual(dict(self.menubuilder.render_many(['main', 'footer'])),
+                             expected)
+            self.assertEqual(len(calls), 1)
+
+    def test_fragments_blueprint(self):
+        self.menubuilder.add_menu('plain')
+        self.menubuilder.add_menu_entry('plain', "One", "one")
+        self.menubuilder.add_menu_entry('plain', "Two", "two")
+        self.app.register_blueprint(
+            self.menubuilder.create_blueprint(cache_control='max-age=30'),
+            url_prefix='/_menus'
+        )
+        client = self.app.test_client()
+
+        response = client.get('/_menus/plain.html?path=/two')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=30')
+        with self.app.test_request_context('/two'):
+            self.assertEqual(response.data, self.menubuilder.render('plain'))
+        etag = response.headers['ETag']
+
+        teardowns = []
+        self.app.teardown_request(lambda exc: teardowns.append(exc))
+        response = client.get('/_menus/plain.html?path=/two',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # Only the real request's, not the page's it's rendered for
+        self.assertEqual(len(teardowns), 1)
+
+        # The ETag is the output's, the same from every process
+        plain = self.menubuilder.menus['plain']
+        plain.changed()
+        response = client.get('/_menus/plain.html?path=/two',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        activewhen = plain.entries['two'].activewhen
+        plain.entries['two'].activewhen = EndpointIn('one')
+        plain.changed()
+        etag = client.get('/_menus/plain.html?path=/two').headers['ETag']
+        plain.entries['two'].activewhen = EndpointIn('one', 'two')
+        plain.changed()
+        response = client.get('/_menus/plain.html?path=/two',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        plain.entries['two'].activewhen = activewhen
+        plain.changed()
+        etag = client.get('/_menus/plain.html?path=/two').headers['ETag']
+
+        def deployed_etag(path):
+            app = Flask(__name__)
+            app.add_url_rule(path, 'one', lambda: None)
+            menubuilder = MenuBuilder(app)
+            menubuilder.add_menu('plain')
+            menubuilder.add_menu_entry('plain', "One", 'one')
+            app.register_blueprint(menubuilder.create_blueprint(), url_prefix='/_menus')
+            response = app.test_client().get('/_menus/plain.html')
+            self.assertEqual(response.status_code, 200)
+            return response.headers['ETag']
+        self.assertEqual(deployed_etag('/one'), deployed_etag('/one'))
+        self.assertNotEqual(deployed_etag('/one'), deployed_etag('/renamed'))
+        response = client.get('/_menus/plain.html?path=/one',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        response = client.get('/_menus/plain.json?path=/one')
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(
+            [(entry['href'], entry['active']) for entry in data['entries']],
+            [('/one', True), ('/two', False)]
+        )
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # The main menu has custom predicates
+        response = client.get('/_menus/main.html')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse('ETag' in response.headers)
+        self.assertEqual(client.get('/_menus/missing.html').status_code, 404)
+
+    def test_lazy_entries(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder()
+        admin = Blueprint('admin', __name__)
+        menubuilder.add_lazy_menu('main', classes='nav')
+
+        @app.route('/')
+        @menubuilder.entry('main', "Home", priority=-1)
+        def index():
+            pass
+
+        @admin.route('/users')
+        @menubuilder.entry('main', "Users", blueprint=admin)
+        def users():
+            pass
+
+        @admin.route('/groups')
+        def groups():
+            pass
+
+        menubuilder.add_lazy_entries('admin', [{'title': "Groups", 'endpoint': 'groups'}],
+                                     blueprint=admin)
+        menubuilder.init_app(app)
+        app.register_blueprint(admin, url_prefix='/admin')
+        self.assertEqual(menubuilder._menus, {})
+
+        with app.test_request_context('/'):
+            self.assertEqual(str(menubuilder.render('main')), """\
+<ul class="nav active"><li class="active"><a class="active" href="/">Home</a></li>
+<li class="inactive"><a class="inactive" href="/admin/users">Users</a></li></ul>""")
+        self.assertTrue(menubuilder.has_menu_endpoint('admin.groups', 'admin'))
+
+    def test_lazy_entries_lookups(self):
+        def create_app():
+            app = Flask(__name__)
+            menubuilder = MenuBuilder(app)
+            for endpoint in ('index', 'docs', 'intro'):
+                app.add_url_rule('/' + endpoint, endpoint, lambda: None)
+            menubuilder.add_lazy_entries('main', [
+                {'title': "Home", 'endpoint': 'index', 'id_': 'home'},
+                {'title': "Docs", 'endpoint': 'docs', 'submenu': {
+                    'lazy': True, 'entries': [{'title': "Intro", 'endpoint': 'intro'}]
+                }},
+            ])
+            app.register_blueprint(menubuilder.create_blueprint(), url_prefix='/_menus')
+            return app, menubuilder
+
+        # Lookups build the lazy definitions, like rendering does
+        app, menubuilder = create_app()
+        self.assertTrue(menubuilder.has_menu_endpoint('index'))
+        app, menubuilder = create_app()
+        self.assertEqual(menubuilder.get_item_by_id('home').endpoint, 'index')
+        app, menubuilder = create_app()
+        self.assertEqual(len(menubuilder.items_for_endpoint('docs')), 1)
+        # The first request of a worker
+        app, menubuilder = create_app()
+        self.assertEqual(app.test_client().get('/_menus/main/docs.html').status_code, 200)
+
+    def test_locale_variants(self):
+        lookups = []
+
+        class LazyString(object):
+            translations = {'pt': u"In\xedcio"}
+
+            def __unicode__(self):
+                locale = request.args.get('lang', 'en')
+                lookups.append(locale)
+                return self.translations.get(locale, u"Home")
+
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(
+            app, locale_selector=lambda: request.args.get('lang', 'en'),
+            locale_cache_size=1
+        )
+
+        @app.route('/')
+        def index():
+            pass
+
+        @app.route('/logo')
+        def logo():
+            pass
+
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', LazyString(), 'index')
+        menubuilder.add_menu_item('main', MenuItemContent(
+            "Logo", title=LazyString(), endpoint='logo'
+        ))
+
+        for lang, title in (('en', u"Home"), ('pt', u"In\xedcio")):
+            with app.test_request_context('/?lang=' + lang):
+                rendered = unicode(menubuilder.render('main'))
+                self.assertIn(u'>{0}</a>'.format(title), rendered)
+                self.assertIn(u'title="{0}"'.format(title), rendered)
+                # Translations are only looked up when compiling the variant
+                del lookups[:]
+                self.assertEqual(unicode(menubuilder.render('main')), rendered)
+                self.assertEqual(lookups, [])
+        self.assertEqual(len(menubuilder.locale_variants), 1)
+
+        # The english variant was evicted
+        with app.test_request_context('/?lang=en'):
+            menubuilder.render('main')
+        self.assertTrue(lookups)
+        self.assertEqual(set(lookups), set(['en']))
+
+        # Plain titles aren't compiled per locale, submenus share the variant
+        # of their root menu
+        @app.route('/about')
+        def about():
+            pass
+
+        main = menubuilder.menus['main']
+        submenu = main.entries['index'].add_submenu()
+        submenu.add_menu_entry(LazyString(), 'about')
+        menubuilder.add_menu_entry('main', "Plain", 'about')
+        with app.test_request_context('/?lang=pt'):
+            menubuilder.render('main')
+        self.assertEqual(len(menubuilder.locale_variants), 1)
+        variant = menubuilder.locale_variants.get((main, main.version, 'pt'))
+        self.assertEqual(
+            set(variant), set([main.entries['index'], main.entries['logo'],
+                               submenu.entries['about']])
+        )
+
+        # Lazy HTML options aren't frozen in the variants
+        class Tip(object):
+            def __unicode__(self):
+                return request.args['tip']
+
+        @app.route('/help')
+        def help():
+            pass
+
+        menubuilder.add_menu_entry('main', LazyString(), 'help', rel=Tip())
+        for tip in ('a', 'b'):
+            with app.test_request_context('/?lang=pt&tip=' + tip):
+                self.assertIn(u'rel="{0}"'.format(tip), menubuilder.render('main'))
+
+    def test_search(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app)
+        for endpoint in ('users', 'user_groups', 'settings', 'audit_log'):
+            app.add_url_rule('/' + endpoint, endpoint, lambda: None)
+        menubuilder.add_menu('admin')
+        menubuilder.add_menu_entry('admin', "Users", 'users')
+        menubuilder.add_menu_entry('admin', "User Groups", 'user_groups', id_='groups')
+        settings = menubuilder.add_menu_entry('admin', "Settings", 'settings')
+        settings.add_submenu('settings', visiblewhen=lambda menu: 'all' in request.args)
+        settings.submenu.add_menu_entry("Audit Log", 'audit_log')
+
+        with app.test_request_context('/?all=1'):
+            search = lambda query, limit=10: [
+                item.endpoint for item in menubuilder.search(query, limit)
+            ]
+            # Whole word matches first
+            self.assertEqual(search("user"), ['user_groups', 'users'])
+            self.assertEqual(search("users"), ['users'])
+            self.assertEqual(search("gro us"), ['user_groups'])
+            self.assertEqual(search("GROUPS"), ['user_groups'])
+            self.assertEqual(search("user", limit=1), ['user_groups'])
+            self.assertEqual(search("audit"), ['audit_log'])
+            self.assertEqual(search("nothing"), [])
+            self.assertEqual(search(""), [])
+
+        with app.test_request_context('/'):
+            # Within a menu not visible
+            self.assertEqual(menubuilder.search("audit"), [])
+
+        with app.test_request_context('/?all=1'):
+            settings.title = "Preferences"
+            self.assertEqual(menubuilder.search("settings")[0].endpoint, 'settings')
+            self.assertEqual(menubuilder.search("pref")[0].endpoint, 'settings')
+            menubuilder.menus['admin'].remove_menu_item('settings')
+            self.assertEqual(menubuilder.search("pref"), [])
+            self.assertEqual(menubuilder.search("audit"), [])
+
+    def test_search_translated_titles(self):
+        class LazyString(object):
+            def __init__(self, translations):
+                self.translations = translations
+
+            def __unicode__(self):
+                return self.translations[request.args.get('lang', 'en')]
+
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app, locale_selector=lambda: request.args.get('lang', 'en'))
+        for endpoint in ('index', 'users'):
+            app.add_url_rule('/' + endpoint, endpoint, lambda: None)
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', LazyString({'en': u"Home", 'pt': u"In\xedcio"}),
+                                   'index')
+        users = menubuilder.add_menu_entry(
+            'main', LazyString({'en': u"People", 'pt': u"Pessoas"}), 'users'
+        )
+
+        def search(query, lang):
+            with app.test_request_context('/?lang=' + lang):
+                return [item.endpoint for item in menubuilder.search(query)]
+
+        self.assertEqual(search(u"home", 'en'), ['index'])
+        self.assertEqual(search(u"in\xed", 'pt'), ['index'])
+        self.assertEqual(search(u"home", 'pt'), [])
+        # The endpoints are still searched, along with the resolved titles
+        self.assertEqual(search(u"users pe", 'pt'), ['users'])
+        users.title = LazyString({'en': u"Members", 'pt': u"Membros"})
+        self.assertEqual(search(u"mem", 'en'), ['users'])
+        self.assertEqual(search(u"people", 'en'), [])
+
+    def test_breadcrumbs(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app, format='xhtml')
+        for endpoint in ('index', 'admin', 'users', 'user_groups'):
+            app.add_url_rule('/' + endpoint, endpoint, lambda: None)
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', "Home", 'index')
+        admin = menubuilder.add_menu_entry('main', "Admin", 'admin')
+        admin.add_submenu('admin')
+        users = admin.submenu.add_menu_entry("Users", 'users')
+        users.add_submenu('users')
+        users.submenu.add_menu_entry("Groups", 'user_groups')
+
+        with app.test_request_context('/user_groups'):
+            self.assertEqual(menubuilder.breadcrumbs(), [
+                admin, users, users.submenu.entries['user_groups']
+            ])
+            self.assertEqual(str(render_template_string("{{ breadcrumbs() }}")), """\
+<ol class="breadcrumbs"><li><a href="/admin">Admin</a></li>
+<li><a href="/users">Users</a></li>
+<li class="active">Groups</li></ol>""")
+            self.assertEqual(
+                [item.title for item in menubuilder.breadcrumbs(endpoint='admin')],
+                ["Admin"]
+            )
+            self.assertEqual(menubuilder.breadcrumbs('other'), [])
+
+        with app.test_request_context('/index'):
+            self.assertEqual(str(menubuilder.render_breadcrumbs(class_='crumbs')), """\
+<ol class="crumbs"><li class="active">Home</li></ol>""")
+
+        @app.route('/elsewhere')
+        def elsewhere():
+            pass
+
+        with app.test_request_context('/elsewhere'):
+            self.assertEqual(menubuilder.breadcrumbs(), [])
+            self.assertEqual(str(menubuilder.render_breadcrumbs()), "")
+
+    def test_menu_snapshots(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app, predicate_workers=0)
+        for n in range(50):
+            app.add_url_rule('/{0}'.format(n), 'item_{0}'.format(n), lambda: None)
+        menubuilder.add_menu('main')
+        for n in range(25):
+            menubuilder.add_menu_entry('main', "Item {0}".format(n), 'item_{0}'.format(n))
+        menu = menubuilder.menus['main']
+
+        snapshot = menu.snapshot
+        self.assertTrue(menu.snapshot is snapshot)
+        menubuilder.add_menu_entry('main', "Item 25", 'item_25')
+        # Published snapshots are never changed
+        self.assertEqual(len(snapshot.entries), 25)
+        self.assertEqual(len(menu.snapshot.entries), 26)
+        self.assertEqual(menu.version, snapshot.version + 1)
+        menu.remove_menu_item('item_25')
+
+        errors = []
+        done = threading.Event()
+
+        def render():
+            with app.test_request_context('/0'):
+                while not done.is_set():
+                    try:
+                        menubuilder.render('main')
+                    except Exception as error:
+                        errors.append(error)
+                        return
+
+        threads = [threading.Thread(target=render) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(20):
+            for n in range(25, 50):
+                menubuilder.add_menu_entry('main', "Item {0}".format(n), 'item_{0}'.format(n))
+            for n in range(25, 50):
+                menu.remove_menu_item('item_{0}'.format(n))
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(menu.snapshot.entries), 25)
+
+    def test_submenu_changes_while_reattached(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app, predicate_workers=0)
+        menubuilder.add_menu('main')
+        docs = menubuilder.add_menu_entry('main', "Docs", 'docs')
+        submenu = docs.add_submenu()
+        menu = menubuilder.menus['main']
+
+        def change_submenu():
+            for n in range(500):
+                submenu.add_menu_entry("Page", 'page')
+                submenu.remove_menu_item('page')
+
+        def reattach_parent():
+            for n in range(500):
+                menu.remove_menu_item('docs')
+                menu.add_menu_item(docs)
+
+        # A lock order inversion between the menu and its submenu deadlocks
+        threads = [threading.Thread(target=change_submenu),
+                   threading.Thread(target=reattach_parent)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(list(menu.entries), ['docs'])
+        self.assertEqual(len(submenu.snapshot.entries), 0)
+
+    def test_lazy_submenus(self):
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app)
+        for endpoint in ('index', 'docs', 'intro', 'api'):
+            app.add_url_rule('/' + endpoint, endpoint, lambda: None)
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', "Home", 'index')
+        docs = menubuilder.add_menu_entry('main', "Docs", 'docs')
+        docs.add_submenu(lazy=True)
+        docs.submenu.add_menu_entry("Intro", 'intro')
+        docs.submenu.add_menu_entry("API", 'api')
+
+        with app.test_request_context('/index'):
+            self.assertRaises(RuntimeWarning, menubuilder.render, 'main')
+        app.register_blueprint(menubuilder.create_blueprint(), url_prefix='/_menus')
+
+        menubuilder.compile()
+        with app.test_request_context('/index'):
+            rendered = str(menubuilder.render('main'))
+            self.assertFalse('Intro' in rendered)
+            self.assertTrue('data-fragment="/_menus/main/docs.html?path=%2Findex"' in rendered)
+            self.assertTrue('class="lazy"' in rendered)
+            data = menubuilder.menus['main'].to_dict()
+            self.assertEqual(data['entries'][0]['entries'], None)
+            self.assertEqual(data['entries'][0]['fragment'],
+                             '/_menus/main/docs.json?path=%2Findex')
+        # Rendered within the active trail
+        with app.test_request_context('/api'):
+            self.assertEqual(str(menubuilder.render('main')), """\
+<ul class="active"><li class="inactive active-trail"><a class="inactive" href="/docs">Docs</a>\
+<ul class="active"><li class="active"><a class="active" href="/api">API</a></li>
+<li class="inactive"><a class="inactive" href="/intro">Intro</a></li></ul></li>
+<li class="inactive"><a class="inactive" href="/index">Home</a></li></ul>""")
+
+        client = app.test_client()
+        response = client.get('/_menus/main/docs.html?path=%2Findex')
+        self.assertEqual(response.data, b"""\
+<ul class="active"><li class="inactive"><a class="inactive" href="/api">API</a></li>
+<li class="inactive"><a class="inactive" href="/intro">Intro</a></li></ul>""")
+        self.assertNotEqual(
+            response.headers['ETag'], client.get('/_menus/main.html').headers['ETag']
+        )
+        response = client.get('/_menus/main/docs.json?path=%2Fintro')
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([entry['active'] for entry in data['entries']], [False, True])
+        self.assertEqual(client.get('/_menus/main/index.html').status_code, 404)
+
+    def test_warmup(self):
+        from click.testing import CliRunner
+        from flask.cli import ScriptInfo
+
+        app = Flask(__name__)
+        menubuilder = MenuBuilder(app)
+        app.add_url_rule('/', 'index', lambda: None)
+        app.add_url_rule('/users/<int:user_id>', 'user', lambda user_id: None)
+        menubuilder.add_menu('main')
+        menubuilder.add_menu_entry('main', "Home", 'index')
+        menubuilder.add_menu('footer')
+        menubuilder.add_menu_entry('footer', "Home", 'index')
+        menubuilder.add_menu_item('footer', MenuItemContent("Copyright", is_link=False,
+                                                            endpoint='copyright'))
+
+        timings = menubuilder.warmup(render=True)
+        self.assertEqual(list(timings), ['footer', 'main'])
+        self.assertTrue(menubuilder.menus['main'].compiled)
+        self.assertTrue(('index', 'http://localhost/') in menubuilder.href_cache)
+
+        runner = CliRunner()
+        info = ScriptInfo(create_app=lambda info: app)
+        result = runner.invoke(app.cli, ['menubuilder', 'warmup', '--render',
+                                         '--base-url', 'https://example.com/'],
+                               obj=info)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([line.split()[0] for line in result.output.splitlines()],
+                         ['footer', 'main'])
+        # Memoized for the URL root requests will have
+        self.assertTrue(('index', 'https://example.com/') in menubuilder.href_cache)
+
+        home = menubuilder.menus['main'].entries['index']
+        home.add_submenu()
+        home.submenu.add_menu_entry("User", 'user')
+        menubuilder.add_menu_entry('main', "Missing", 'missing')
+        with self.assertRaises(RuntimeWarning) as raised:
+            menubuilder.warmup()
+        self.assertEqual(sorted(raised.exception.args[1]), [
+            "main: Cannot build an URL for the endpoint 'user'",
+            "main: Unknown endpoint 'missing'",
+        ])
+        result = runner.invoke(app.cli, ['menubuilder', 'warmup'], obj=info)
+        self.assertEqual(result.exit_code, 1)
+        self.assertTrue("Unknown endpoint 'missing'" in result.output)
+
+    def test_markup_builder(self):
+        html, xhtml = MarkupBuilder(), MarkupBuilder('xhtml')
+
+        class LazyString(object):
+            def __unicode__(self):
+                return u'<Lazy>'
+
+        self.assertEqual(
+            html.a(u'One & Two', None, rel='next', href='/?a=1&b="2"', class_='x', id_='one'),
+            u'<a id="one" class="x" href="/?a=1&amp;b=&quot;2&quot;" rel="next">One & Two</a>'
+        )
+        self.assertEqual(html.li(title=LazyString(), class_=None), u'<li title="&lt;Lazy&gt;"></li>')
+        self.assertEqual(html.span(disabled=True, nowrap=False), u'<span disabled></span>')
+        self.assertEqual(xhtml.span(disabled=True), u'<span disabled="disabled"></span>')
+        self.assertEqual(html.ul(Markup(u'<li></li>'), class_=Markup(u'a&amp;b')),
+                         u'<ul class="a&amp;b"><li></li></ul>')
+        # A plain string equal to cached markup is still escaped
+        self.assertEqual(html.ul(class_=u'a&amp;b'), u'<ul class="a&amp;amp;b"></ul>')
+
+        # The same output as werkzeug's generic builder, compiled or not
+        if werkzeug_html is None:
+            self.skipTest("werkzeug's HTML builder isn't available")
+        with self.app.test_request_context('/one'):
+            rendered = self.menubuilder.render('main')
+            self.menubuilder.compile()
+            self.assertEqual(self.menubuilder.render('main'), rendered)
+            self.menubuilder.builder = werkzeug_html
+            self.menubuilder.menus['main'].builder = werkzeug_html
+            for entry in self.menubuilder.menus['main'].sorted_entries:
+                entry.builder = werkzeug_html
+            self.menubuilder.compile()
+            self.assertEqual(self.menubuilder.render('main'), rendered)
 
 
 def suite():